@@ -69,18 +69,51 @@ class ComfyUIBatchClient:
         
         result = response.json()
         return result["task_ids"]
-    
+
+    def submit_workflow(self, workflow: Dict = None, template_id: str = None, overrides: List[str] = None,
+                        variants: List[Dict] = None, **kwargs) -> List[str]:
+        """提交任意工作流（API格式工作流或模板ID + "节点ID.输入名=值" 覆盖），每个变体一个任务"""
+        data = {
+            "workflow": workflow,
+            "template_id": template_id,
+            "params": kwargs.get("params", {}),
+            "overrides": overrides or [],
+            "images": kwargs.get("images", {}),
+            "output_nodes": kwargs.get("output_nodes", []),
+            "variants": variants or [],
+            "batch_name": kwargs.get("batch_name"),
+            "priority": kwargs.get("priority", 0)
+        }
+
+        response = requests.post(f"{self.api_server}/workflow", json=data)
+        response.raise_for_status()
+
+        result = response.json()
+        return result["task_ids"]
+
     def get_task_status(self, task_id: str) -> Dict:
         """获取任务状态"""
         response = requests.get(f"{self.api_server}/status/{task_id}")
         response.raise_for_status()
         return response.json()
     
-    def get_all_tasks(self) -> List[Dict]:
-        """获取所有任务"""
-        response = requests.get(f"{self.api_server}/tasks")
-        response.raise_for_status()
-        return response.json()["tasks"]
+    def get_all_tasks(self, status: str = None, batch_name: str = None, page_size: int = 500) -> List[Dict]:
+        """获取所有任务（按next_cursor自动翻页）"""
+        params = {"limit": page_size}
+        if status:
+            params["status"] = status
+        if batch_name:
+            params["batch_name"] = batch_name
+        
+        tasks = []
+        while True:
+            response = requests.get(f"{self.api_server}/tasks", params=params)
+            response.raise_for_status()
+            result = response.json()
+            tasks.extend(result["tasks"])
+            if not result.get("next_cursor"):
+                return tasks
+            params["cursor"] = result["next_cursor"]
     
     def wait_for_task(self, task_id: str, timeout: int = 300) -> Dict:
         """等待任务完成"""
@@ -113,10 +146,12 @@ class ComfyUIBatchClient:
     
     async def monitor_tasks_realtime(self, task_ids: List[str]):
         """实时监控任务进度（WebSocket）"""
-        ws_url = self.api_server.replace("http", "ws") + "/ws"
+        ws_url = self.api_server.replace("http", "ws") + "/ws?subscribe=none"
         
         try:
             async with websockets.connect(ws_url) as websocket:
+                # 只订阅关心的任务，不接收其他客户端的任务更新
+                await websocket.send(json.dumps({"action": "subscribe", "task_ids": task_ids}))
                 print("✅ WebSocket连接成功，开始实时监控...")
                 
                 completed_tasks = set()
@@ -126,7 +161,13 @@ class ComfyUIBatchClient:
                         message = await asyncio.wait_for(websocket.recv(), timeout=1.0)
                         data = json.loads(message)
                         
-                        if data["type"] == "task_update":
+                        if data["type"] == "task_progress":
+                            # 进度消息只包含变化的字段
+                            progress = data["data"]
+                            if progress["task_id"] in task_ids and "progress" in progress:
+                                print(f"⏳ 任务进度 {progress['task_id'][:8]}: {progress['progress']:.1f}% {progress.get('message', '')}")
+                        
+                        elif data["type"] == "task_update":
                             task_data = data["data"]
                             task_id = task_data["task_id"]
                             
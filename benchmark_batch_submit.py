@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+/batch 批量提交受理延迟基准测试
+
+在临时目录中创建独立的tasks.db，直接调用 /batch 的处理函数，
+只测量"解析请求 + 事务批量插入 + 入队"的耗时，不会连接ComfyUI，也不会真正生成图片。
+
+用法: python benchmark_batch_submit.py [批量大小 ...]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+BATCH_SIZES = [10, 1000, 10000]
+ROUNDS = 3
+
+
+def make_payload(size: int) -> dict:
+    """构造批量请求数据"""
+    return {
+        "batch_name": f"bench_{size}",
+        "priority": 0,
+        "requests": [
+            {
+                "prompt": f"benchmark prompt #{i}, a cute cat sitting on a sofa",
+                "width": 1024,
+                "height": 1024,
+                "steps": 8,
+                "batch_size": 1
+            }
+            for i in range(size)
+        ]
+    }
+
+
+async def run_benchmark(server, sizes):
+    print("📊 /batch 受理延迟（解析 + 批量插入 + 入队）")
+    print("=" * 60)
+    print(f"{'批量大小':>10} | {'最快(ms)':>10} | {'平均(ms)':>10} | {'每任务(µs)':>10}")
+    print("-" * 60)
+
+    for size in sizes:
+        payload = make_payload(size)
+        timings = []
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            batch_request = server.BatchRequest(**payload)
+            result = await server.generate_batch(batch_request)
+            timings.append(time.perf_counter() - start)
+            assert len(result["task_ids"]) == size
+
+        best = min(timings) * 1000
+        avg = sum(timings) / len(timings) * 1000
+        per_task = avg * 1000 / size
+        print(f"{size:>10} | {best:>10.1f} | {avg:>10.1f} | {per_task:>10.1f}")
+
+    print("-" * 60)
+    print(f"🗃️ 数据库统计: {server.task_manager.db.get_stats()}")
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or BATCH_SIZES
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # 服务器模块使用相对路径的tasks.db和图片目录，切换到临时目录避免污染正式数据
+        os.chdir(work_dir)
+        import comfyui_api_server as server
+
+        asyncio.run(run_benchmark(server, sizes))
+        server.task_manager.db.close()
+
+
+if __name__ == "__main__":
+    main()
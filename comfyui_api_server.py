@@ -16,25 +16,41 @@ ComfyUI批量生图API服务器
 版本: 1.0
 """
 
-from fastapi import FastAPI, BackgroundTasks, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi import FastAPI, HTTPException, Query, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple, Union
 import asyncio
 import aiohttp
 import websockets
 import json
 import uuid
 import time
+import itertools
+import socket
+import threading
+import concurrent.futures
+import base64
+import hashlib
+import io
+import random
+import struct
+from queue import Queue, Empty
 import os
-import shutil
 from pathlib import Path
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import sqlite3
 from contextlib import asynccontextmanager
+from multipart.multipart import MultipartParser, parse_options_header
+from collections import OrderedDict, deque
+
+try:
+    from PIL import Image, ImageOps  # 可选依赖：上传前缩小输入图片
+except ImportError:
+    Image = None
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -43,11 +59,88 @@ logger = logging.getLogger(__name__)
 # 配置
 COMFYUI_SERVER = "http://117.50.172.15:8188"
 COMFYUI_WS = "ws://117.50.172.15:8188/ws"
+# 多后端节点池：逗号分隔的ComfyUI地址列表，未配置时只使用COMFYUI_SERVER
+COMFYUI_SERVERS = [url.strip().rstrip("/") for url in os.getenv("COMFYUI_SERVERS", COMFYUI_SERVER).split(",") if url.strip()]
 OUTPUT_DIR = Path("./generated_images")
+UPLOAD_DIR = Path("./uploaded_images")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))  # 单张上传图片的大小上限
+UPLOAD_MAX_FILES = 100  # /upload_images 单次最多上传的文件数
+UPLOAD_ALLOWED_EXTENSIONS = {".png", ".jpg", ".webp", ".gif", ".bmp"}  # 按文件头识别的允许格式
+WORKFLOW_TEMPLATE_DIR = Path(os.path.dirname(os.path.abspath(__file__))) / "workflow_templates"  # 工作流模板规格目录
+TEXT_TO_IMAGE_TEMPLATE = "qwen_text_to_image"  # 无输入图片时使用的模板
+IMAGE_EDIT_TEMPLATE = "qwen_image_edit"  # 有输入图片时使用的模板
+LEGACY_OUTPUT_NODES = ["60", "8", "115:116"]  # 模板声明的输出节点没有图片时依次尝试
 DB_PATH = "./tasks.db"
+DB_BUSY_TIMEOUT_MS = 5000  # SQLite锁等待超时（毫秒）
+DB_MAX_BATCH = 500  # 写线程单个事务最多合并的操作数
+TASKS_PAGE_DEFAULT = 100  # /tasks 默认每页条数
+TASKS_PAGE_MAX = 1000  # /tasks 每页最大条数
+TASK_CACHE_SIZE = int(os.getenv("TASK_CACHE_SIZE", "1000"))  # 内存中缓存的已结束任务数上限（未结束任务始终常驻）
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "2"))  # 进度写回数据库的间隔（秒）
+
+# ComfyUI HTTP连接池配置（进程内所有任务共享同一个连接池）
+COMFYUI_POOL_LIMIT = int(os.getenv("COMFYUI_POOL_LIMIT", "100"))  # 连接总数上限
+COMFYUI_POOL_LIMIT_PER_HOST = int(os.getenv("COMFYUI_POOL_LIMIT_PER_HOST", "32"))  # 单个ComfyUI主机连接上限
+COMFYUI_KEEPALIVE_TIMEOUT = float(os.getenv("COMFYUI_KEEPALIVE_TIMEOUT", "30"))  # 空闲连接保活秒数
+COMFYUI_CONNECT_TIMEOUT = float(os.getenv("COMFYUI_CONNECT_TIMEOUT", "10"))  # 连接超时
+COMFYUI_REQUEST_TIMEOUT = float(os.getenv("COMFYUI_REQUEST_TIMEOUT", "60"))  # 单次请求总超时
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))  # 全局同时从ComfyUI下载的图片数
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # 下载时每次写入磁盘的块大小
+# 结果图片回传方式：http（SaveImage写入ComfyUI输出目录后经/view下载）或 websocket（改用SaveImageWebsocket经共享WebSocket直接推送）
+RESULT_DELIVERY = os.getenv("RESULT_DELIVERY", "http")
+
+# ComfyUI WebSocket事件监听配置
+COMFYUI_WS_RECONNECT_DELAY = 3  # WebSocket断开后重连间隔（秒）
+HISTORY_FALLBACK_INTERVAL = 2  # WebSocket不可用时回退轮询/history的间隔（秒）
+HISTORY_SAFETY_INTERVAL = 30  # WebSocket正常时兜底检查/history的间隔（秒）
+WS_BINARY_IMAGE = 1  # 二进制帧事件类型：图片（帧头为 事件类型、图片格式 两个大端uint32，其后是图片数据）
+QUEUE_POSITION_INTERVAL = 3  # 任务在ComfyUI排队时刷新队列位置的间隔（秒）
+TASK_TIMEOUT = 300  # 单个任务等待ComfyUI完成的超时（秒）
+
+# ComfyUI执行阶段的任务进度：排队 35%，开始执行 40%，各节点按权重分摊 40%~90%，下载保存 90%~100%
+NODE_PROGRESS_WEIGHTS = {
+    "KSampler": 60,
+    "KSamplerAdvanced": 60,
+    "SamplerCustom": 60,
+    "SamplerCustomAdvanced": 60,
+    "UNETLoader": 10,
+    "CheckpointLoaderSimple": 10,
+    "CLIPLoader": 5,
+    "VAELoader": 2,
+    "LoraLoaderModelOnly": 3,
+    "CLIPTextEncode": 2,
+    "TextEncodeQwenImageEditPlus": 4,
+    "VAEEncode": 4,
+    "VAEDecode": 8,
+    "SaveImage": 3,
+    "SaveImageWebsocket": 3
+}
+
+# 后端节点健康检查配置
+BACKEND_HEALTH_INTERVAL = 10  # 后台健康检查间隔（秒）
+BACKEND_LOAD_MAX_AGE = 2  # 路由时队列深度数据的最大有效期（秒），过期则现查/queue
+BACKEND_MAX_FAILURES = 3  # 连续失败多少次后摘除节点（不再分配新任务）
+OBJECT_INFO_MAX_AGE = 600  # /object_info 缓存的最长有效期（秒），节点重连后立即失效
+OBJECT_INFO_RECHECK_AGE = 30  # 校验失败且缓存超过该时间（秒）时重新拉取一次再判定（可能刚安装了新模型/节点）
+UPLOAD_HASH_CACHE_SIZE = 4096  # 缓存内容哈希的本地图片文件数
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") == "1"  # 上传到ComfyUI前按工作流的像素预算缩小输入图片（需要Pillow）
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))  # 图片预处理进程数
+INPUT_IMAGE_MAX_PIXELS = int(os.getenv("INPUT_IMAGE_MAX_PIXELS", "0"))  # 没有缩放节点的输入图片的像素上限，0为不限制
+
+# 任务调度配置
+WORKERS_PER_BACKEND = int(os.getenv("WORKERS_PER_BACKEND", "2"))  # 每个ComfyUI节点同时处理的任务数
+
+# WebSocket推送配置
+WS_SEND_QUEUE_SIZE = 256  # 每个连接待发送消息上限，超出时丢弃最旧的
+WS_SEND_TIMEOUT = 10  # 单条消息发送超时（秒），超时视为慢客户端
+WS_SLOW_CONSUMER_TIMEOUT = 30  # 发送队列持续溢出超过该时间（秒）则断开连接
+EVENT_BUFFER_SIZE = 5000  # 保留最近的推送事件数，用于断线重连后补发（/ws?since= 和 /events）
+SSE_KEEPALIVE_INTERVAL = 15  # SSE心跳间隔（秒）
+TASK_PROGRESS_EVENT_INTERVAL = float(os.getenv("TASK_PROGRESS_EVENT_INTERVAL", "0.5"))  # 同一任务进度推送的最小间隔（秒）
 
 # 创建必要目录
 OUTPUT_DIR.mkdir(exist_ok=True)
+UPLOAD_DIR.mkdir(exist_ok=True)
 
 class GenerationRequest(BaseModel):
     """单个生成请求"""
@@ -61,6 +154,48 @@ class GenerationRequest(BaseModel):
     batch_size: int = 1
     batch_name: Optional[str] = None
     input_image: Optional[str] = None  # 输入图片的文件名
+    input_images: List[str] = []  # 多张参考图片的文件名（依次对应image1..imageN，可与input_image同时使用）
+
+class WorkflowRequest(BaseModel):
+    """任意工作流请求：ComfyUI API格式工作流或已注册模板 + 参数覆盖"""
+    workflow: Optional[Dict[str, Any]] = None  # API格式工作流（与template_id二选一）
+    template_id: Optional[str] = None  # 已注册的工作流模板ID（见 /workflow_templates）
+    params: Dict[str, Any] = {}  # 模板参数（prompt、seed、width等），仅模板可用
+    overrides: Union[List[str], Dict[str, Any]] = []  # "节点ID.输入名=值" 列表或 {"节点ID.输入名": 值}
+    images: Dict[str, str] = {}  # "节点ID.输入名" -> 已通过/upload_image上传的文件名，提交前上传到ComfyUI
+    output_nodes: List[str] = []  # 收集图片的节点，默认为模板声明的输出节点或所有SaveImage节点
+    batch_name: Optional[str] = None
+
+class WorkflowVariant(BaseModel):
+    """批量提交工作流时的单个变体（覆盖公共参数）"""
+    params: Dict[str, Any] = {}
+    overrides: Union[List[str], Dict[str, Any]] = []
+    images: Dict[str, str] = {}
+
+class WorkflowBatchRequest(WorkflowRequest):
+    """工作流提交请求：不带variants时生成一个任务，否则每个变体一个任务"""
+    variants: List[WorkflowVariant] = []
+    priority: int = 0
+
+class PipelineStage(BaseModel):
+    """流水线中的一个阶段（API格式工作流或已注册模板 + 参数覆盖）"""
+    workflow: Optional[Dict[str, Any]] = None
+    template_id: Optional[str] = None
+    params: Dict[str, Any] = {}
+    overrides: Union[List[str], Dict[str, Any]] = []
+    input: Optional[str] = None  # 接收上一阶段输出图片的 "节点ID.输入名"，默认为模板的第一个图片槽位或第一个LoadImage
+    output_nodes: List[str] = []
+
+class PipelineRequest(BaseModel):
+    """多阶段流水线：上一阶段的每张输出图片直接在ComfyUI节点上作为下一阶段的输入（逐张展开）"""
+    stages: List[PipelineStage]
+    images: Dict[str, str] = {}  # 第一阶段的输入图片："节点ID.输入名" -> 已上传的文件名
+    batch_name: Optional[str] = None
+
+class PipelineBatchRequest(PipelineRequest):
+    """流水线提交请求：variants覆盖第一阶段的参数，每个变体一个任务"""
+    variants: List[WorkflowVariant] = []
+    priority: int = 0
 
 class BatchRequest(BaseModel):
     """批量生成请求"""
@@ -80,30 +215,908 @@ class TaskStatus(BaseModel):
     result_urls: Optional[List[str]] = None  # 支持多张图片
     error: Optional[str] = None
     request_data: Optional[Dict] = None  # 生成参数
+    prompt_id: Optional[str] = None  # ComfyUI中的prompt_id（用于重启后重新关联）
+    backend: Optional[str] = None  # 执行该任务的ComfyUI节点地址
+    queue_position: Optional[int] = None  # 在ComfyUI队列中的排队位置（1表示下一个执行），开始执行后为空
+    batch_name: Optional[str] = None  # 所属批次（用于WebSocket按批次订阅）
 
-class ComfyUIManager:
-    """ComfyUI连接管理器"""
+class ComfyUIClientPool:
+    """ComfyUI HTTP连接池（进程级共享，随应用生命周期创建和关闭）"""
+
+    def __init__(self, limit: int = COMFYUI_POOL_LIMIT, limit_per_host: int = COMFYUI_POOL_LIMIT_PER_HOST,
+                 keepalive_timeout: float = COMFYUI_KEEPALIVE_TIMEOUT,
+                 connect_timeout: float = COMFYUI_CONNECT_TIMEOUT,
+                 request_timeout: float = COMFYUI_REQUEST_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout, connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "sessions_created": 0
+        }
+        self._download_semaphore: Optional[asyncio.Semaphore] = None  # 在事件循环内惰性创建
+        self.download_stats = {
+            "downloads": 0,
+            "failures": 0,
+            "retries": 0,
+            "bytes": 0,
+            "in_progress": 0,
+            "waiting": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+            "total_wait_seconds": 0.0
+        }
+
+    def _create_trace_config(self) -> aiohttp.TraceConfig:
+        """统计请求数、新建连接数和复用连接数"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.stats["requests"] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            self.stats["connections_created"] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.stats["connections_reused"] += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        """创建共享的ClientSession（keep-alive + 每主机连接数限制）"""
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300
+        )
+        self.stats["sessions_created"] += 1
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            trace_configs=[self._create_trace_config()]
+        )
+
+    async def start(self):
+        """启动连接池"""
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+            logger.info(f"🔌 ComfyUI连接池已启动 (limit={self.limit}, limit_per_host={self.limit_per_host}, keepalive={self.keepalive_timeout}s)")
+
+    async def close(self):
+        """关闭连接池"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+            logger.info("🔌 ComfyUI连接池已关闭")
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """获取共享session（未经lifespan启动时惰性创建）"""
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    @property
+    def download_semaphore(self) -> asyncio.Semaphore:
+        if self._download_semaphore is None:
+            self._download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        return self._download_semaphore
+
+    def record_download(self, size: int, seconds: float, wait_seconds: float):
+        self.download_stats["downloads"] += 1
+        self.download_stats["bytes"] += size
+        self.download_stats["total_seconds"] += seconds
+        self.download_stats["total_wait_seconds"] += wait_seconds
+        self.download_stats["max_seconds"] = max(self.download_stats["max_seconds"], seconds)
+
+    def get_download_stats(self) -> Dict:
+        """图片下载统计（字节数、耗时、排队等待时间）"""
+        stats = dict(self.download_stats)
+        downloads = stats["downloads"]
+        stats["avg_seconds"] = round(stats["total_seconds"] / downloads, 4) if downloads else 0.0
+        stats["avg_wait_seconds"] = round(stats["total_wait_seconds"] / downloads, 4) if downloads else 0.0
+        stats["throughput_mb_per_second"] = round(stats["bytes"] / stats["total_seconds"] / (1024 * 1024), 2) if stats["total_seconds"] else 0.0
+        for key in ("total_seconds", "max_seconds", "total_wait_seconds"):
+            stats[key] = round(stats[key], 4)
+        stats["concurrency"] = DOWNLOAD_CONCURRENCY
+        return stats
+
+    def get_stats(self) -> Dict:
+        """连接池统计信息（用于验证连接复用情况）"""
+        acquired = self.stats["connections_created"] + self.stats["connections_reused"]
+        stats = dict(self.stats)
+        stats["reuse_ratio"] = round(self.stats["connections_reused"] / acquired, 4) if acquired else 0.0
+        stats["limit"] = self.limit
+        stats["limit_per_host"] = self.limit_per_host
+        if self._session and not self._session.closed:
+            connector = self._session.connector
+            # 当前空闲（可复用）的keep-alive连接数
+            stats["idle_connections"] = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        else:
+            stats["idle_connections"] = 0
+        return stats
+
+# 全局ComfyUI连接池
+comfy_pool = ComfyUIClientPool()
+
+class PromptWaiter:
+    """单个prompt的完成等待器"""
+
+    def __init__(self, prompt_id: str, on_event=None):
+        self.prompt_id = prompt_id
+        self.on_event = on_event  # 可选回调：on_event(event_type, data)
+        self.done = asyncio.Event()
+        self.wakeup = asyncio.Event()  # 连接状态变化时唤醒等待方，立即检查一次/history
+        self.status: Optional[str] = None  # success, error
+        self.error: Optional[str] = None
+        self.outputs: Dict[str, Any] = {}
+        self.image_nodes: set = set()  # 经WebSocket推送结果图片的SaveImageWebsocket节点
+        self.on_image = None  # 可选回调：on_image(node_id, data)，接收上述节点推送的图片
+
+    def finish(self, status: str, error: Optional[str] = None):
+        if self.done.is_set():
+            return
+        self.status = status
+        self.error = error
+        self.done.set()
+        self.wakeup.set()
+
+class ComfyUIEventListener:
+    """ComfyUI WebSocket事件监听器（每个后端一条共享连接，按prompt_id分发事件）"""
+
+    def __init__(self, ws_url: str, client_id: Optional[str] = None, max_finished: int = 1000):
+        self.ws_url = ws_url
+        self.client_id = client_id or str(uuid.uuid4())
+        self.connected = False
+        self.waiters: Dict[str, PromptWaiter] = {}
+        # 最近结束的prompt（防止事件先于等待器注册到达）
+        self._finished: "OrderedDict[str, tuple]" = OrderedDict()
+        self._max_finished = max_finished
+        self._task: Optional[asyncio.Task] = None
+        self.on_connect = None  # 可选回调：每次（重新）连接成功时调用
+        self.running_prompt: Optional[str] = None  # 正在执行的prompt（旧版ComfyUI的progress消息不带prompt_id）
+        self.running_node: Optional[str] = None  # 正在执行的节点（二进制帧不带prompt_id和节点ID，按它归属）
+        self.stats = {
+            "connects": 0,
+            "disconnects": 0,
+            "messages": 0,
+            "completions": 0,
+            "images": 0,
+            "image_bytes": 0
+        }
+
+    async def start(self):
+        """启动后台监听任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止监听"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.connected = False
+
+    async def _run(self):
+        url = f"{self.ws_url}?clientId={self.client_id}"
+        while True:
+            try:
+                async with websockets.connect(url, max_size=None, ping_interval=20) as ws:
+                    self.connected = True
+                    self.stats["connects"] += 1
+                    logger.info(f"🔗 ComfyUI WebSocket已连接: {self.ws_url}")
+                    # 重连后唤醒所有等待方，补查断线期间可能错过的完成事件
+                    self._wake_all()
+                    if self.on_connect:
+                        self.on_connect()
+                    async for raw in ws:
+                        if isinstance(raw, bytes):
+                            self._dispatch_binary(raw)
+                            continue
+                        self.stats["messages"] += 1
+                        try:
+                            self._dispatch(json.loads(raw))
+                        except Exception as e:
+                            logger.warning(f"⚠️ 处理ComfyUI WebSocket消息失败: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ ComfyUI WebSocket连接异常: {e}，{COMFYUI_WS_RECONNECT_DELAY}秒后重连")
+            if self.connected:
+                self.stats["disconnects"] += 1
+            self.connected = False
+            # 断线后唤醒所有等待方，切换到/history轮询
+            self._wake_all()
+            await asyncio.sleep(COMFYUI_WS_RECONNECT_DELAY)
+
+    def _wake_all(self):
+        for waiter in self.waiters.values():
+            waiter.wakeup.set()
+
+    def _dispatch(self, message: Dict):
+        """按prompt_id分发事件"""
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id and msg_type == "progress":
+            prompt_id = self.running_prompt
+        if not prompt_id:
+            return
+        if msg_type == "execution_start" or (msg_type == "executing" and data.get("node") is not None):
+            self.running_prompt = prompt_id
+            self.running_node = data.get("node")
+
+        waiter = self.waiters.get(prompt_id)
+        if msg_type == "executed" and waiter:
+            waiter.outputs[data.get("node")] = data.get("output")
+
+        if msg_type == "executing" and data.get("node") is None:
+            self._finish(prompt_id, "success")
+        elif msg_type == "execution_success":
+            self._finish(prompt_id, "success")
+        elif msg_type == "execution_error":
+            self._finish(prompt_id, "error", data.get("exception_message") or "ComfyUI执行出错")
+        elif msg_type == "execution_interrupted":
+            self._finish(prompt_id, "error", "ComfyUI任务被中断")
+
+        if waiter and waiter.on_event:
+            try:
+                waiter.on_event(msg_type, data)
+            except Exception as e:
+                logger.warning(f"⚠️ prompt {prompt_id} 事件回调失败: {e}")
+
+    def _dispatch_binary(self, raw: bytes):
+        """二进制帧：SaveImageWebsocket节点执行期间推送的图片交给对应prompt的等待器，其余（采样预览图）忽略"""
+        if len(raw) <= 8 or not self.running_prompt:
+            return
+        waiter = self.waiters.get(self.running_prompt)
+        if not waiter or not waiter.on_image or self.running_node not in waiter.image_nodes:
+            return
+        event_type, _ = struct.unpack(">II", raw[:8])
+        if event_type != WS_BINARY_IMAGE:
+            return
+        self.stats["images"] += 1
+        self.stats["image_bytes"] += len(raw) - 8
+        try:
+            waiter.on_image(self.running_node, memoryview(raw)[8:])
+        except Exception as e:
+            logger.warning(f"⚠️ prompt {self.running_prompt} 处理推送图片失败: {e}")
+
+    def _finish(self, prompt_id: str, status: str, error: Optional[str] = None):
+        if self.running_prompt == prompt_id:
+            self.running_prompt = None
+            self.running_node = None
+        waiter = self.waiters.get(prompt_id)
+        if waiter:
+            if not waiter.done.is_set():
+                self.stats["completions"] += 1
+            waiter.finish(status, error)
+            return
+        if prompt_id in self._finished:
+            return  # 与PromptWaiter.finish一致只保留第一个结果（execution_error之后还会收到executing node=None）
+        self._finished[prompt_id] = (status, error)
+        while len(self._finished) > self._max_finished:
+            self._finished.popitem(last=False)
+
+    def register(self, prompt_id: str, on_event=None, image_nodes: Optional[List[str]] = None,
+                 on_image=None) -> PromptWaiter:
+        """注册等待器（如果完成事件已先到达则立即标记完成）"""
+        waiter = PromptWaiter(prompt_id, on_event)
+        waiter.image_nodes = set(image_nodes or [])
+        waiter.on_image = on_image
+        self.waiters[prompt_id] = waiter
+        finished = self._finished.pop(prompt_id, None)
+        if finished:
+            self.stats["completions"] += 1
+            waiter.finish(*finished)
+        return waiter
+
+    def unregister(self, prompt_id: str):
+        self.waiters.pop(prompt_id, None)
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["connected"] = self.connected
+        stats["waiting_prompts"] = len(self.waiters)
+        return stats
+
+def detect_image_type(data: bytes) -> Tuple[str, str]:
+    """根据文件头判断图片格式，返回 (扩展名, content_type)；无法识别时返回 ("", "application/octet-stream")"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png", "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return ".jpg", "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp", "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif", "image/gif"
+    if data.startswith(b"BM"):
+        return ".bmp", "image/bmp"
+    return "", "application/octet-stream"
+
+def preprocess_image(data: bytes, max_pixels: int) -> Optional[Tuple[bytes, str, str]]:
+    """缩小超过像素预算的图片并重新编码，返回 (图片数据, 扩展名, content_type)；在进程池中执行
+
+    先按EXIF方向旋转再缩放（输出不再携带EXIF），带透明通道的保存为PNG，其余保存为JPEG。
+    未超过预算时返回None（直接上传原图，不必把数据传回主进程）。
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width * image.height <= max_pixels:
+            return None
+        image = ImageOps.exif_transpose(image)
+        scale = (max_pixels / (image.width * image.height)) ** 0.5
+        size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+        resample = getattr(Image, "Resampling", Image).LANCZOS
+        image = image.convert("RGBA" if has_alpha else "RGB").resize(size, resample)
+        buffer = io.BytesIO()
+        if has_alpha:
+            image.save(buffer, format="PNG")
+            return buffer.getvalue(), ".png", "image/png"
+        image.save(buffer, format="JPEG", quality=95)
+        return buffer.getvalue(), ".jpg", "image/jpeg"
+
+def get_input_pixel_budgets(workflow: Dict) -> Dict[str, int]:
+    """每个LoadImage节点的像素预算：图片只被 ImageScaleToTotalPixels 使用时，超出其目标像素的部分在GPU端也会被缩掉
+
+    返回 LoadImage节点ID -> 像素数（0表示不限制）。
+    """
+    consumers: Dict[str, List[Optional[float]]] = {}
+    for node in workflow.values():
+        for value in (node.get("inputs") or {}).values():
+            if isinstance(value, list) and len(value) == 2:
+                source = str(value[0])
+                megapixels = None
+                if value[1] == 0 and node.get("class_type") == "ImageScaleToTotalPixels":
+                    megapixels = node["inputs"].get("megapixels")
+                    megapixels = megapixels if isinstance(megapixels, (int, float)) else None
+                consumers.setdefault(source, []).append(megapixels)
+    budgets = {}
+    for node_id, node in workflow.items():
+        if node.get("class_type") != "LoadImage":
+            continue
+        uses = consumers.get(node_id) or [None]
+        if all(megapixels is not None for megapixels in uses):
+            # ComfyUI按 megapixels * 1024 * 1024 计算总像素
+            budgets[node_id] = int(max(uses) * 1024 * 1024)
+        else:
+            budgets[node_id] = INPUT_IMAGE_MAX_PIXELS
+    return budgets
+
+class WorkflowValidationError(Exception):
+    """工作流本地校验失败（不需要提交到ComfyUI就能确定的错误）"""
+
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+        super().__init__("工作流校验失败: " + "; ".join(errors[:5]) + (" ..." if len(errors) > 5 else ""))
+
+class ComfyUISchema:
+    """编译后的 /object_info：每个节点类型的必填/可选输入、枚举值、数值范围和输出数量"""
+
+    def __init__(self, object_info: Dict):
+        self.nodes: Dict[str, Dict] = {}
+        for class_type, info in object_info.items():
+            inputs = info.get("input") or {}
+            required = {name: self._compile_input(spec) for name, spec in (inputs.get("required") or {}).items()}
+            optional = {name: self._compile_input(spec) for name, spec in (inputs.get("optional") or {}).items()}
+            self.nodes[class_type] = {
+                "required": required,
+                "inputs": {**optional, **required},
+                "outputs": len(info.get("output") or [])
+            }
+        self.loaded_at = time.time()
+
+    @staticmethod
+    def _compile_input(spec) -> Dict:
+        """输入定义 [类型或枚举列表, {选项}] -> {"enum": frozenset|None, "min": .., "max": .., "upload": bool}"""
+        if not isinstance(spec, (list, tuple)) or not spec:
+            return {"enum": None}
+        kind = spec[0]
+        options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+        enum = None
+        if isinstance(kind, list):
+            enum = frozenset(v for v in kind if isinstance(v, (str, int, float, bool)))
+        elif kind == "COMBO" and isinstance(options.get("options"), list):
+            enum = frozenset(v for v in options["options"] if isinstance(v, (str, int, float, bool)))
+        compiled = {"enum": enum, "upload": bool(options.get("image_upload") or options.get("upload"))}
+        if kind in ("INT", "FLOAT"):
+            compiled["min"] = options.get("min")
+            compiled["max"] = options.get("max")
+        return compiled
+
+    def validate(self, workflow: Dict) -> List[str]:
+        """校验API格式工作流，返回错误列表（为空表示通过）"""
+        errors = []
+        for node_id, node in workflow.items():
+            class_type = node.get("class_type") if isinstance(node, dict) else None
+            if not class_type:
+                errors.append(f"节点 {node_id} 缺少class_type")
+                continue
+            schema = self.nodes.get(class_type)
+            if schema is None:
+                errors.append(f"节点 {node_id}: ComfyUI中不存在节点类型 {class_type}")
+                continue
+            inputs = node.get("inputs") or {}
+            for name in schema["required"]:
+                if name not in inputs:
+                    errors.append(f"节点 {node_id}({class_type}) 缺少必填输入 {name}")
+            for name, value in inputs.items():
+                if isinstance(value, list):
+                    # 连线: [来源节点ID, 输出序号]
+                    if len(value) != 2 or str(value[0]) not in workflow:
+                        errors.append(f"节点 {node_id}.{name} 连接到不存在的节点 {value[0] if value else value}")
+                        continue
+                    source = workflow[str(value[0])]
+                    source_schema = self.nodes.get(source.get("class_type")) if isinstance(source, dict) else None
+                    if source_schema and isinstance(value[1], int) and value[1] >= source_schema["outputs"]:
+                        errors.append(f"节点 {node_id}.{name} 连接的输出序号 {value[1]} 超出节点 {value[0]} 的输出数量")
+                    continue
+                spec = schema["inputs"].get(name)
+                if spec is None:
+                    continue
+                # 上传类输入（如LoadImage的image）的文件是提交前才上传的，不在缓存的枚举里
+                if spec["enum"] is not None and not spec["upload"] and value not in spec["enum"]:
+                    errors.append(f"节点 {node_id}({class_type}) 的 {name}={value!r} 不在ComfyUI可选值中")
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    if spec.get("min") is not None and value < spec["min"]:
+                        errors.append(f"节点 {node_id}({class_type}) 的 {name}={value} 小于最小值 {spec['min']}")
+                    if spec.get("max") is not None and value > spec["max"]:
+                        errors.append(f"节点 {node_id}({class_type}) 的 {name}={value} 大于最大值 {spec['max']}")
+        return errors
+
+class ComfyUIBackend:
+    """单个ComfyUI后端节点（独立的WebSocket监听器和负载状态）"""
+
+    def __init__(self, url: str, ws_url: Optional[str] = None):
+        self.url = url.rstrip("/")
+        if ws_url is None:
+            ws_url = self.url.replace("https://", "wss://", 1).replace("http://", "ws://", 1) + "/ws"
+        self.ws_url = ws_url
+        # 固定的client_id：服务重启后用同一个id重连，ComfyUI会把仍在执行的prompt事件继续推送过来
+        client_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{socket.gethostname()}|{os.path.abspath(DB_PATH)}|{self.url}"))
+        self.listener = ComfyUIEventListener(self.ws_url, client_id)
+        self.healthy = True  # 首次检查前乐观认为可用
+        self.consecutive_failures = 0
+        self.queue_running = 0
+        self.queue_pending = 0
+        self.pending_prompt_ids: List[str] = []  # 按执行顺序排列的排队中prompt
+        self.running_prompt_ids: List[str] = []
+        self.assigned_since_refresh = 0  # 上次刷新/queue后新路由到该节点的任务数
+        self.inflight = 0  # 本服务正在该节点上处理的任务数
+        self.last_refresh = 0.0
+        self.vram_free: Optional[float] = None
+        self.comfyui_version: Optional[str] = None
+        self.last_queue_refresh = 0.0
+        self._queue_refresh: Optional[asyncio.Task] = None  # 进行中的/queue请求（多个任务共享）
+        # 连接代数：WebSocket每次（重新）连接加一，节点可能已重启，依赖节点状态的缓存据此失效
+        self.generation = 0
+        self.schema: Optional[ComfyUISchema] = None
+        self._schema_refresh: Optional[asyncio.Task] = None
+        # 已上传的输入图片：内容sha256 -> ComfyUI中的图片名；进行中的上传按sha256合并
+        self.uploaded_images: Dict[str, str] = {}
+        self._uploads: Dict[str, asyncio.Task] = {}
+        self.listener.on_connect = self._on_reconnect
     
-    def __init__(self):
-        self.client_id = str(uuid.uuid4())
+    def _on_reconnect(self):
+        self.generation += 1
+        self.schema = None  # 节点可能重启过（模型、自定义节点可能变化），下次使用时重新拉取/object_info
+        self.uploaded_images.clear()  # 重启后input目录可能已被清理，已上传的图片需要重新上传
+    
+    def apply_queue(self, queue: Dict):
+        """更新/queue快照；队列项格式: [number, prompt_id, prompt, extra_data, outputs_to_execute]"""
+        running = queue.get("queue_running", [])
+        pending = sorted(queue.get("queue_pending", []), key=lambda item: item[0])
+        self.running_prompt_ids = [item[1] for item in running]
+        self.pending_prompt_ids = [item[1] for item in pending]
+        self.queue_running = len(running)
+        self.queue_pending = len(pending)
+        self.assigned_since_refresh = 0
+        self.last_queue_refresh = time.time()
+    
+    def queue_position(self, prompt_id: str) -> Optional[int]:
+        """prompt在最近一次队列快照中的位置：排队中返回1起的序号，执行中返回0，不在队列中返回None"""
+        if prompt_id in self.running_prompt_ids:
+            return 0
+        try:
+            return self.pending_prompt_ids.index(prompt_id) + 1
+        except ValueError:
+            return None
+
+    @property
+    def queue_depth(self) -> int:
+        """估算的真实队列深度：ComfyUI队列 + 刷新后新分配的任务"""
+        return self.queue_running + self.queue_pending + self.assigned_since_refresh
+
+    def record_success(self):
+        if not self.healthy:
+            logger.info(f"✅ ComfyUI节点恢复可用: {self.url}")
+        self.healthy = True
+        self.consecutive_failures = 0
+
+    def record_failure(self, reason: str):
+        self.consecutive_failures += 1
+        if self.healthy and self.consecutive_failures >= BACKEND_MAX_FAILURES:
+            self.healthy = False
+            logger.error(f"❌ ComfyUI节点连续失败{self.consecutive_failures}次，已摘除: {self.url} ({reason})")
+
+    def to_dict(self) -> Dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "consecutive_failures": self.consecutive_failures,
+            "queue_running": self.queue_running,
+            "queue_pending": self.queue_pending,
+            "queue_depth": self.queue_depth,
+            "inflight": self.inflight,
+            "vram_free": self.vram_free,
+            "comfyui_version": self.comfyui_version,
+            "ws_connected": self.listener.connected,
+            "generation": self.generation,
+            "schema_loaded": self.schema is not None,
+            "uploaded_images": len(self.uploaded_images),
+            "last_refresh": datetime.fromtimestamp(self.last_refresh).isoformat() if self.last_refresh else None
+        }
+
+class ComfyUIBackendPool:
+    """ComfyUI后端节点池（按真实队列深度路由，自动摘除/恢复不健康节点）"""
+
+    def __init__(self, urls: List[str], pool: Optional[ComfyUIClientPool] = None,
+                 max_concurrency_per_backend: int = WORKERS_PER_BACKEND):
+        self.pool = pool or comfy_pool
+        self.backends: List[ComfyUIBackend] = [
+            ComfyUIBackend(url, COMFYUI_WS if url == COMFYUI_SERVER else None) for url in urls
+        ]
+        self.max_concurrency_per_backend = max_concurrency_per_backend
+        self._slot_released: Optional[asyncio.Event] = None  # 在事件循环内惰性创建
+        self.prompt_backends: Dict[str, ComfyUIBackend] = {}  # prompt_id -> 所在节点
+        self._monitor_task: Optional[asyncio.Task] = None
+        # 本地文件 (路径, 大小, 修改时间) -> sha256，同一张参考图只计算一次哈希
+        self._file_hashes: OrderedDict = OrderedDict()
+        self.upload_stats = {"uploads": 0, "hits": 0, "coalesced": 0, "bytes_uploaded": 0, "bytes_saved": 0,
+                             "preprocessed": 0, "preprocess_bytes_in": 0, "preprocess_bytes_out": 0}
+        self.delivery_stats = {"websocket_tasks": 0, "websocket_images": 0, "websocket_bytes": 0, "fallbacks": 0}
+        self._image_executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    async def start(self):
+        """启动各节点的WebSocket监听和后台健康检查"""
+        if IMAGE_PREPROCESS and Image is None:
+            logger.warning("⚠️ 已启用 IMAGE_PREPROCESS 但未安装Pillow，输入图片将按原图上传（pip install Pillow，或设置 IMAGE_PREPROCESS=0 关闭此提示）")
+        for backend in self.backends:
+            await backend.listener.start()
+        await self.refresh_all()
+        # 预取节点定义，API入口校验可以立即使用
+        for backend in self.backends:
+            if backend.healthy:
+                backend._schema_refresh = asyncio.create_task(self._fetch_schema(backend))
+        if self._monitor_task is None or self._monitor_task.done():
+            self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def stop(self):
+        if self._monitor_task:
+            self._monitor_task.cancel()
+            try:
+                await self._monitor_task
+            except asyncio.CancelledError:
+                pass
+            self._monitor_task = None
+        for backend in self.backends:
+            await backend.listener.stop()
+        if self._image_executor:
+            self._image_executor.shutdown(wait=False, cancel_futures=True)
+            self._image_executor = None
+    
+    @property
+    def image_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # 图片解码/缩放是CPU密集操作，放到独立进程避免占用事件循环和GIL
+        if self._image_executor is None:
+            self._image_executor = concurrent.futures.ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+        return self._image_executor
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+            try:
+                await self.refresh_all()
+            except Exception as e:
+                logger.warning(f"⚠️ ComfyUI节点健康检查异常: {e}")
+
+    async def refresh_all(self):
+        await asyncio.gather(*(self.refresh_backend(b) for b in self.backends))
+
+    async def refresh_backend(self, backend: ComfyUIBackend):
+        """从/queue和/system_stats刷新节点负载与健康状态"""
+        timeout = aiohttp.ClientTimeout(total=5)
+        try:
+            session = self.pool.session
+            async with session.get(f"{backend.url}/queue", timeout=timeout) as response:
+                if response.status != 200:
+                    raise Exception(f"/queue 状态码 {response.status}")
+                queue = await response.json()
+            async with session.get(f"{backend.url}/system_stats", timeout=timeout) as response:
+                if response.status != 200:
+                    raise Exception(f"/system_stats 状态码 {response.status}")
+                system_stats = await response.json()
+        except Exception as e:
+            backend.record_failure(str(e) or type(e).__name__)
+            return
+
+        backend.apply_queue(queue)
+        backend.last_refresh = time.time()
+        devices = system_stats.get("devices") or []
+        backend.vram_free = sum(d.get("vram_free", 0) for d in devices) if devices else None
+        backend.comfyui_version = (system_stats.get("system") or {}).get("comfyui_version")
+        backend.record_success()
+
+    async def get_queue_position(self, backend: ComfyUIBackend, prompt_id: str,
+                                 max_age: float = QUEUE_POSITION_INTERVAL) -> Optional[int]:
+        """查询prompt的排队位置（队列快照超过max_age才重新请求/queue，并发查询共享同一个请求）"""
+        if time.time() - backend.last_queue_refresh > max_age:
+            if backend._queue_refresh is None or backend._queue_refresh.done():
+                backend._queue_refresh = asyncio.create_task(self._refresh_queue(backend))
+            await asyncio.shield(backend._queue_refresh)
+        return backend.queue_position(prompt_id)
+    
+    async def _refresh_queue(self, backend: ComfyUIBackend):
+        try:
+            timeout = aiohttp.ClientTimeout(total=5)
+            async with self.pool.session.get(f"{backend.url}/queue", timeout=timeout) as response:
+                if response.status != 200:
+                    return
+                backend.apply_queue(await response.json())
+        except Exception as e:
+            logger.warning(f"⚠️ 获取ComfyUI队列失败: {backend.url} ({e})")
+    
+    async def get_schema(self, backend: ComfyUIBackend, max_age: float = OBJECT_INFO_MAX_AGE) -> Optional[ComfyUISchema]:
+        """获取节点的 /object_info 编译结果（缓存，超过max_age或节点重连后重新拉取，并发请求共享）"""
+        schema = backend.schema
+        if schema is not None and time.time() - schema.loaded_at <= max_age:
+            return schema
+        if backend._schema_refresh is None or backend._schema_refresh.done():
+            backend._schema_refresh = asyncio.create_task(self._fetch_schema(backend))
+        await asyncio.shield(backend._schema_refresh)
+        return backend.schema
+    
+    async def _fetch_schema(self, backend: ComfyUIBackend):
+        generation = backend.generation
+        try:
+            timeout = aiohttp.ClientTimeout(total=30)
+            async with self.pool.session.get(f"{backend.url}/object_info", timeout=timeout) as response:
+                if response.status != 200:
+                    raise Exception(f"状态码 {response.status}")
+                body = await response.read()
+            # /object_info 通常有数MB，解析和编译放到线程池，避免阻塞事件循环
+            loop = asyncio.get_running_loop()
+            schema = await loop.run_in_executor(None, lambda: ComfyUISchema(json.loads(body)))
+        except Exception as e:
+            logger.warning(f"⚠️ 获取ComfyUI节点定义失败: {backend.url} ({e})")
+            return
+        if backend.generation == generation:
+            backend.schema = schema
+            logger.info(f"📚 已缓存ComfyUI节点定义: {backend.url} ({len(schema.nodes)} 种节点)")
+    
+    def cached_schema(self) -> Optional[ComfyUISchema]:
+        """API入口校验用：任一健康节点已缓存的节点定义（不等待网络请求，过期时在后台刷新）"""
+        for backend in sorted(self.backends, key=lambda b: not b.healthy):
+            schema = backend.schema
+            if schema is None or time.time() - schema.loaded_at > OBJECT_INFO_MAX_AGE:
+                if backend.healthy and (backend._schema_refresh is None or backend._schema_refresh.done()):
+                    backend._schema_refresh = asyncio.create_task(self._fetch_schema(backend))
+            if schema is not None:
+                return schema
+        return None
+    
+    async def validate_workflow(self, workflow: Dict, backend: Optional[ComfyUIBackend] = None):
+        """本地校验工作流，失败抛出 WorkflowValidationError；还没有节点定义时跳过校验
+
+        指定backend时使用该节点的节点定义（提交前校验），否则使用任一已缓存的（API入口校验）。
+        校验失败且缓存已有一段时间时重新拉取一次再判定，避免刚安装的模型被误判。
+        """
+        schema = await self.get_schema(backend) if backend else self.cached_schema()
+        if schema is None:
+            return
+        errors = schema.validate(workflow)
+        if errors and time.time() - schema.loaded_at > OBJECT_INFO_RECHECK_AGE:
+            target = backend or next((b for b in self.backends if b.schema is schema), None)
+            if target is not None:
+                schema = await self.get_schema(target, max_age=0)
+                errors = schema.validate(workflow) if schema else []
+        if errors:
+            raise WorkflowValidationError(errors)
+    
+    @staticmethod
+    def _read_and_hash(path: Path) -> Tuple[str, bytes]:
+        """读取文件并计算sha256（在线程池中执行，不访问哈希缓存）"""
+        with open(path, "rb") as f:
+            data = f.read()
+        return hashlib.sha256(data).hexdigest(), data
+    
+    async def _hash_file(self, path: Path) -> Tuple[str, Optional[bytes], int]:
+        """返回 (sha256, 文件内容或None, 大小)；哈希已缓存且文件未变化时不读取文件
+
+        线程池中只做stat和读取/哈希，缓存的查询和更新都在事件循环中进行。
+        """
+        loop = asyncio.get_running_loop()
+        stat = await loop.run_in_executor(None, path.stat)
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        digest = self._file_hashes.get(key)
+        if digest is not None:
+            self._file_hashes.move_to_end(key)
+            return digest, None, stat.st_size
+        digest, data = await loop.run_in_executor(None, self._read_and_hash, path)
+        self._file_hashes[key] = digest
+        while len(self._file_hashes) > UPLOAD_HASH_CACHE_SIZE:
+            self._file_hashes.popitem(last=False)
+        return digest, data, len(data)
+    
+    async def upload_cached_image(self, backend: ComfyUIBackend, filename: str, max_pixels: int = 0) -> str:
+        """上传 uploaded_images/ 中的图片到指定节点，按内容哈希去重
+
+        同一节点上内容相同的图片只上传一次（ComfyUI中的文件名为内容哈希），
+        并发上传同一张图片时合并为一个请求；节点重连（可能已重启）后缓存失效。
+        max_pixels 不为0且安装了Pillow时，超过像素预算的图片先在进程池中缩小再上传。
+        合并的上传任务使用自己的ComfyUIManager，不受发起者提前退出或取消的影响。
+        """
+        path = UPLOAD_DIR / filename
+        if not path.exists():
+            raise Exception(f"本地图片文件不存在: {filename}")
+        loop = asyncio.get_running_loop()
+        digest, data, size = await self._hash_file(path)
+        preprocess = bool(max_pixels and IMAGE_PREPROCESS and Image is not None)
+        key = f"{digest}@{max_pixels}" if preprocess else digest
+        
+        name = backend.uploaded_images.get(key)
+        if name is not None:
+            self.upload_stats["hits"] += 1
+            self.upload_stats["bytes_saved"] += size
+            return name
+        upload = backend._uploads.get(key)
+        if upload is not None:
+            self.upload_stats["coalesced"] += 1
+            self.upload_stats["bytes_saved"] += size
+            return await asyncio.shield(upload)
+        
+        async def do_upload() -> str:
+            generation = backend.generation
+            image_data = data
+            if image_data is None:
+                image_data = await loop.run_in_executor(None, path.read_bytes)
+            extension, content_type = detect_image_type(image_data)
+            stem = digest[:32]
+            if preprocess:
+                try:
+                    processed = await loop.run_in_executor(self.image_executor, preprocess_image, image_data, max_pixels)
+                    if processed is not None:
+                        self.upload_stats["preprocessed"] += 1
+                        self.upload_stats["preprocess_bytes_in"] += len(image_data)
+                        self.upload_stats["preprocess_bytes_out"] += len(processed[0])
+                        image_data, extension, content_type = processed
+                        stem = f"{stem}_{max_pixels}"
+                except Exception as e:
+                    logger.warning(f"⚠️ 图片预处理失败，上传原图: {filename} ({e})")
+            async with ComfyUIManager(backend, self.pool) as comfy:
+                comfy_name = await comfy.upload_image_to_comfyui(image_data, f"{stem}{extension or path.suffix.lower()}",
+                                                                 content_type)
+            self.upload_stats["uploads"] += 1
+            self.upload_stats["bytes_uploaded"] += len(image_data)
+            if backend.generation == generation:
+                backend.uploaded_images[key] = comfy_name
+            return comfy_name
+        
+        upload = asyncio.create_task(do_upload())
+        backend._uploads[key] = upload
+        upload.add_done_callback(lambda _: backend._uploads.pop(key, None))
+        return await asyncio.shield(upload)
+    
+    def get_upload_stats(self) -> Dict:
+        return {**self.upload_stats, "cached_hashes": len(self._file_hashes),
+                "preprocess_enabled": IMAGE_PREPROCESS and Image is not None}
+    
+    async def websocket_delivery_available(self, backend: ComfyUIBackend) -> bool:
+        """是否经WebSocket接收该节点的结果图片：已启用、WebSocket已连接且节点提供SaveImageWebsocket"""
+        if RESULT_DELIVERY != "websocket" or not backend.listener.connected:
+            return False
+        schema = await self.get_schema(backend)
+        return schema is not None and "SaveImageWebsocket" in schema.nodes
+    
+    def get_delivery_stats(self) -> Dict:
+        return {"mode": RESULT_DELIVERY, **self.delivery_stats}
+    
+    async def acquire_backend(self) -> ComfyUIBackend:
+        """选择队列深度最小且有空闲槽位的健康节点（全部占满时等待槽位释放）"""
+        while True:
+            stale = [b for b in self.backends if b.healthy and time.time() - b.last_refresh > BACKEND_LOAD_MAX_AGE]
+            if stale:
+                await asyncio.gather(*(self.refresh_backend(b) for b in stale))
+
+            candidates = [b for b in self.backends if b.healthy]
+            if not candidates:
+                logger.warning("⚠️ 没有健康的ComfyUI节点，尝试使用全部节点")
+                candidates = self.backends
+            available = [b for b in candidates if b.inflight < self.max_concurrency_per_backend]
+            if available:
+                # 队列深度优先，其次本服务在途任务数，再次空闲显存
+                backend = min(available, key=lambda b: (b.queue_depth, b.inflight, -(b.vram_free or 0)))
+                backend.assigned_since_refresh += 1
+                backend.inflight += 1
+                return backend
+
+            if self._slot_released is None:
+                self._slot_released = asyncio.Event()
+            self._slot_released.clear()
+            try:
+                await asyncio.wait_for(self._slot_released.wait(), timeout=BACKEND_HEALTH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def reserve_backend(self, backend: ComfyUIBackend):
+        """直接占用指定节点的槽位（重新关联已在该节点上执行的任务）"""
+        backend.inflight += 1
+
+    def get_backend_by_url(self, url: Optional[str]) -> Optional[ComfyUIBackend]:
+        for backend in self.backends:
+            if backend.url == url:
+                return backend
+        return None
+
+    def release_backend(self, backend: ComfyUIBackend):
+        backend.inflight = max(0, backend.inflight - 1)
+        if self._slot_released is not None:
+            self._slot_released.set()
+
+    def bind_prompt(self, prompt_id: str, backend: ComfyUIBackend):
+        """记录prompt所在节点（用于后续history/view调用）"""
+        self.prompt_backends[prompt_id] = backend
+
+    def unbind_prompt(self, prompt_id: str):
+        self.prompt_backends.pop(prompt_id, None)
+
+    def get_backend_for_prompt(self, prompt_id: str) -> Optional[ComfyUIBackend]:
+        return self.prompt_backends.get(prompt_id)
+
+    def get_stats(self) -> List[Dict]:
+        return [dict(b.to_dict(), ws=b.listener.get_stats()) for b in self.backends]
+
+# 全局ComfyUI后端节点池
+backend_pool = ComfyUIBackendPool(COMFYUI_SERVERS)
+
+class ComfyUIManager:
+    """ComfyUI连接管理器（使用共享连接池，不再为每个任务单独建立session）"""
+
+    def __init__(self, backend: Optional[ComfyUIBackend] = None,
+                 pool: Optional[ComfyUIClientPool] = None):
+        self.backend = backend or backend_pool.backends[0]
+        self.pool = pool or comfy_pool
+        self.listener = self.backend.listener
+        # 使用该节点监听器的client_id提交，ComfyUI才会把执行事件推送到共享WebSocket
+        self.client_id = self.listener.client_id
         self.session = None
         self.ws = None
-        
+
     async def __aenter__(self):
-        # 设置超时时间：连接超时10秒，读取超时60秒
-        timeout = aiohttp.ClientTimeout(total=60, connect=10)
-        self.session = aiohttp.ClientSession(timeout=timeout)
+        self.session = self.pool.session
         return self
-        
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        # 共享session由连接池统一关闭，这里只释放引用
+        self.session = None
         if self.ws:
             await self.ws.close()
     
     async def submit_prompt(self, workflow: Dict) -> str:
         """提交工作流到ComfyUI（带重试机制）"""
-        url = f"{COMFYUI_SERVER}/prompt"
+        url = f"{self.backend.url}/prompt"
         data = {
             "prompt": workflow,
             "client_id": self.client_id
@@ -116,6 +1129,10 @@ class ComfyUIManager:
                     if response.status == 200:
                         result = await response.json()
                         return result["prompt_id"]
+                    elif response.status == 400:
+                        # ComfyUI校验失败（节点错误），重试结果也一样
+                        error_text = await response.text()
+                        raise WorkflowValidationError([f"ComfyUI拒绝了工作流: {error_text[:500]}"])
                     else:
                         error_text = await response.text()
                         logger.warning(f"提交任务失败，状态码: {response.status}, 错误: {error_text}, 重试 {retry+1}/{max_retries}")
@@ -129,6 +1146,8 @@ class ComfyUIManager:
                     await asyncio.sleep(2)
                     continue
                 raise HTTPException(status_code=500, detail="ComfyUI提交超时")
+            except WorkflowValidationError:
+                raise
             except Exception as e:
                 if retry < max_retries - 1:
                     logger.warning(f"提交任务异常: {e}, 重试 {retry+1}/{max_retries}")
@@ -138,7 +1157,7 @@ class ComfyUIManager:
     
     async def get_history(self, prompt_id: str) -> Dict:
         """获取任务历史（带重试机制）"""
-        url = f"{COMFYUI_SERVER}/history/{prompt_id}"
+        url = f"{self.backend.url}/history/{prompt_id}"
         
         max_retries = 3
         for retry in range(max_retries):
@@ -170,9 +1189,83 @@ class ComfyUIManager:
         
         return {}
     
+    async def wait_for_completion(self, prompt_id: str, timeout: float = TASK_TIMEOUT,
+                                  on_event=None, check_history_first: bool = False,
+                                  image_nodes: Optional[List[str]] = None, on_image=None) -> Dict:
+        """等待prompt完成并返回其history记录
+
+        优先由共享WebSocket事件唤醒；WebSocket断开时回退为定时轮询/history。
+        check_history_first用于重新关联已提交的prompt（可能在等待前就已完成）。
+        image_nodes/on_image 用于接收SaveImageWebsocket节点推送的结果图片。
+        """
+        waiter = self.listener.register(prompt_id, on_event, image_nodes, on_image)
+        if check_history_first:
+            waiter.wakeup.set()
+        deadline = time.monotonic() + timeout
+        consecutive_failures = 0
+        max_consecutive_failures = 10  # 连续失败10次后报错
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                interval = HISTORY_SAFETY_INTERVAL if self.listener.connected else HISTORY_FALLBACK_INTERVAL
+                try:
+                    await asyncio.wait_for(waiter.wakeup.wait(), timeout=min(interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                waiter.wakeup.clear()
+
+                if waiter.done.is_set():
+                    if waiter.status == "error":
+                        raise Exception(f"ComfyUI执行失败: {waiter.error}")
+                    return await self._fetch_completed_history(prompt_id)
+
+                # 没有收到完成事件（断线、兜底检查），查一次/history
+                try:
+                    history = await self.get_history(prompt_id)
+                    consecutive_failures = 0
+                except Exception as e:
+                    consecutive_failures += 1
+                    logger.warning(f"⚠️ prompt {prompt_id} - 获取历史失败 ({consecutive_failures}/{max_consecutive_failures}): {e}")
+                    if consecutive_failures >= max_consecutive_failures:
+                        raise Exception(f"连接ComfyUI服务器失败: {str(e)}")
+                    history = {}
+                if prompt_id in history:
+                    return history[prompt_id]
+        finally:
+            self.listener.unregister(prompt_id)
+
+    async def get_prompt_state(self, prompt_id: str) -> str:
+        """查询prompt在节点上的状态: completed / running / pending / unknown"""
+        history = await self.get_history(prompt_id)
+        if prompt_id in history:
+            return "completed"
+        async with self.session.get(f"{self.backend.url}/queue") as response:
+            if response.status != 200:
+                raise Exception(f"获取队列失败: {response.status}")
+            queue = await response.json()
+        # 队列项格式: [number, prompt_id, prompt, extra_data, outputs_to_execute]
+        if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+            return "running"
+        if any(item[1] == prompt_id for item in queue.get("queue_pending", [])):
+            return "pending"
+        return "unknown"
+
+    async def _fetch_completed_history(self, prompt_id: str) -> Dict:
+        """收到完成事件后获取history（ComfyUI在发出完成事件后才写入history，需短暂重试）"""
+        delay = 0.1
+        for _ in range(20):
+            history = await self.get_history(prompt_id)
+            if prompt_id in history:
+                return history[prompt_id]
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        raise Exception("ComfyUI已完成但未能获取到历史记录")
+    
     async def download_image(self, filename: str, subfolder: str = "", type: str = "output") -> bytes:
         """下载生成的图像（带重试机制）"""
-        url = f"{COMFYUI_SERVER}/view"
+        url = f"{self.backend.url}/view"
         params = {
             "filename": filename,
             "subfolder": subfolder,
@@ -204,13 +1297,69 @@ class ComfyUIManager:
                     continue
                 raise
     
-    async def upload_image_to_comfyui(self, image_data: bytes, filename: str) -> str:
+    async def download_image_to_file(self, filename: str, subfolder: str, type: str, dest: Path) -> int:
+        """从 /view 流式下载图像到文件（带重试机制），返回字节数
+
+        按块写入同目录下的临时文件（写盘在线程池中执行），完成后原子重命名为dest，
+        不会出现写了一半的图片；全局同时下载数受 DOWNLOAD_CONCURRENCY 限制。
+        """
+        url = f"{self.backend.url}/view"
+        params = {
+            "filename": filename,
+            "subfolder": subfolder,
+            "type": type
+        }
+        loop = asyncio.get_running_loop()
+        stats = self.pool.download_stats
+        
+        queued_at = time.perf_counter()
+        stats["waiting"] += 1
+        async with self.pool.download_semaphore:
+            stats["waiting"] -= 1
+            started_at = time.perf_counter()
+            stats["in_progress"] += 1
+            try:
+                max_retries = 3
+                for retry in range(max_retries):
+                    temp_path = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.part")
+                    f = None
+                    try:
+                        async with self.session.get(url, params=params) as response:
+                            if response.status != 200:
+                                raise HTTPException(status_code=404, detail=f"图像下载失败: {response.status}")
+                            f = await loop.run_in_executor(None, open, temp_path, "wb")
+                            size = 0
+                            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                await loop.run_in_executor(None, f.write, chunk)
+                                size += len(chunk)
+                        await loop.run_in_executor(None, f.close)
+                        await loop.run_in_executor(None, os.replace, temp_path, dest)
+                        self.pool.record_download(size, time.perf_counter() - started_at, started_at - queued_at)
+                        return size
+                    except Exception as e:
+                        if f is not None:
+                            await loop.run_in_executor(None, f.close)
+                            await loop.run_in_executor(None, lambda: temp_path.unlink(missing_ok=True))
+                        if retry < max_retries - 1:
+                            stats["retries"] += 1
+                            reason = "超时" if isinstance(e, asyncio.TimeoutError) else (getattr(e, "detail", None) or e)
+                            logger.warning(f"下载图像失败: {reason}, 重试 {retry+1}/{max_retries}")
+                            await asyncio.sleep(1)
+                            continue
+                        stats["failures"] += 1
+                        if isinstance(e, asyncio.TimeoutError):
+                            raise HTTPException(status_code=504, detail="图像下载超时")
+                        raise
+            finally:
+                stats["in_progress"] -= 1
+    
+    async def upload_image_to_comfyui(self, image_data: bytes, filename: str, content_type: Optional[str] = None) -> str:
         """上传图片到ComfyUI服务器"""
-        url = f"{COMFYUI_SERVER}/upload/image"
+        url = f"{self.backend.url}/upload/image"
         
-        # 创建FormData
+        # 创建FormData（未指定类型时按文件头判断）
         data = aiohttp.FormData()
-        data.add_field('image', image_data, filename=filename, content_type='image/jpeg')
+        data.add_field('image', image_data, filename=filename, content_type=content_type or detect_image_type(image_data)[1])
         data.add_field('overwrite', 'true')
         
         try:
@@ -225,139 +1374,760 @@ class ComfyUIManager:
         except Exception as e:
             logger.error(f"❌ ComfyUI图片上传异常: {e}")
             raise e
+    
+    async def upload_local_images(self, filenames: List[str], max_pixels: Optional[List[int]] = None) -> Dict[str, str]:
+        """并发上传 uploaded_images/ 中的多张图片，返回 本地文件名 -> ComfyUI中的图片名（内容相同的图片只上传一次）
 
-class TaskManager:
-    """任务管理器"""
+        max_pixels 与 filenames 一一对应，为每张图片的像素预算（0为不缩小）；同一文件取较大的预算。
+        """
+        budgets: Dict[str, int] = {}
+        for filename, budget in zip(filenames, max_pixels or [0] * len(filenames)):
+            previous = budgets.get(filename)
+            budgets[filename] = budget if previous is None else (0 if not previous or not budget else max(previous, budget))
+        names = await asyncio.gather(*(backend_pool.upload_cached_image(self.backend, filename, budget)
+                                       for filename, budget in budgets.items()))
+        return dict(zip(budgets, names))
+
+class TaskDatabase:
+    """任务数据库（单个长连接，WAL模式，由专用写线程串行执行所有SQL）
+
+    事件循环线程只负责把操作放入队列：
+    - submit(): 不等待结果（用于状态写入）
+    - run(): 在协程中await结果
+    - call(): 同步阻塞等待（仅用于启动阶段）
+    写线程会把队列中积压的操作合并到同一个事务中提交。
+    """
+
+    def __init__(self, db_path: str = DB_PATH, max_batch: int = DB_MAX_BATCH):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self._queue: Queue = Queue()
+        self.stats = {"operations": 0, "transactions": 0, "errors": 0, "max_queue_depth": 0}
+        self._thread = threading.Thread(target=self._run, name="task-db-writer", daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None：由写线程显式控制事务边界
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL下NORMAL保证一致性，只在检查点fsync
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")  # 约16MB页缓存
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            stop = False
+            # 合并积压的操作，一个事务提交
+            while len(batch) < self.max_batch:
+                try:
+                    next_item = self._queue.get_nowait()
+                except Empty:
+                    break
+                if next_item is None:
+                    stop = True
+                    break
+                batch.append(next_item)
+            self._execute_batch(conn, batch)
+            if stop:
+                break
+        conn.close()
+
+    def _execute_batch(self, conn: sqlite3.Connection, batch: List):
+        results = []
+        try:
+            conn.execute("BEGIN")
+            for func, future in batch:
+                # 每个操作一个savepoint，单个操作失败不影响同批次其他操作
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((future, func(conn), None))
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+            self.stats["transactions"] += 1
+        except Exception as e:
+            logger.error(f"❌ 数据库事务提交失败: {e}")
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            results = [(future, None, e) for _, future in batch]
+
+        self.stats["operations"] += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                self.stats["errors"] += 1
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+            elif future.set_running_or_notify_cancel():
+                future.set_result(result)
+
+    def submit(self, func) -> concurrent.futures.Future:
+        """提交操作 func(conn) 到写线程，立即返回Future"""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        future.add_done_callback(self._log_failure)
+        self._queue.put((func, future))
+        depth = self._queue.qsize()
+        if depth > self.stats["max_queue_depth"]:
+            self.stats["max_queue_depth"] = depth
+        return future
+
+    @staticmethod
+    def _log_failure(future: concurrent.futures.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"❌ 数据库操作失败: {future.exception()}")
+
+    async def run(self, func):
+        """在协程中执行数据库操作并等待结果"""
+        return await asyncio.wrap_future(self.submit(func))
+
+    def call(self, func):
+        """同步执行数据库操作（阻塞当前线程，仅用于启动阶段）"""
+        return self.submit(func).result()
+
+    def close(self):
+        """写完队列中剩余操作后关闭连接"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
+
+class TaskCache:
+    """任务状态缓存
+
+    未结束（pending/running）的任务常驻内存，不会被淘汰；
+    已结束（completed/failed）的任务按LRU保留最多 max_size 个，超出时淘汰最久未访问的。
+    被淘汰的任务仍在数据库中，由 TaskManager.get_task 按需重新加载。
+    """
     
-    def __init__(self):
-        self.init_database()
-        self.active_tasks: Dict[str, TaskStatus] = {}
-        self.websocket_connections: List[WebSocket] = []
-        self.load_tasks_from_database()  # 启动时加载数据库中的任务
+    TERMINAL_STATUSES = ("completed", "failed")
     
-    def init_database(self):
-        """初始化数据库"""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+    def __init__(self, max_size: int = TASK_CACHE_SIZE):
+        self.max_size = max_size
+        self._active: Dict[str, TaskStatus] = {}
+        self._finished: "OrderedDict[str, TaskStatus]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+    
+    def put(self, task: TaskStatus):
+        """放入或重新归类任务（状态变为已结束后需要再调用一次）"""
+        task_id = task.task_id
+        if task.status in self.TERMINAL_STATUSES:
+            self._active.pop(task_id, None)
+            self._finished[task_id] = task
+            self._finished.move_to_end(task_id)
+            while len(self._finished) > self.max_size:
+                self._finished.popitem(last=False)
+                self.stats["evictions"] += 1
+        else:
+            self._finished.pop(task_id, None)
+            self._active[task_id] = task
+    
+    def peek(self, task_id: str) -> Optional[TaskStatus]:
+        """内部查找：不影响LRU顺序和命中统计"""
+        return self._active.get(task_id) or self._finished.get(task_id)
+    
+    def get(self, task_id: str) -> Optional[TaskStatus]:
+        task = self._active.get(task_id)
+        if task is None:
+            task = self._finished.get(task_id)
+            if task is not None:
+                self._finished.move_to_end(task_id)
+        self.stats["hits" if task is not None else "misses"] += 1
+        return task
+    
+    def __setitem__(self, task_id: str, task: TaskStatus):
+        self.put(task)
+    
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self._active or task_id in self._finished
+    
+    def __len__(self) -> int:
+        return len(self._active) + len(self._finished)
+    
+    def active_count(self) -> int:
+        return len(self._active)
+    
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["active"] = len(self._active)
+        stats["finished_cached"] = len(self._finished)
+        stats["max_size"] = self.max_size
+        return stats
+
+class WebSocketClient:
+    """单个WebSocket连接的发送端
+
+    每个连接有自己的有界发送队列和写协程，慢客户端不会拖慢其他客户端：
+    同一任务的更新在队列中合并（只保留最新的），队列满时丢弃最旧的消息，
+    并在队首放一条 resync（携带被丢弃的最大seq），客户端据此重新拉取 /tasks 后继续按seq接收；
+    长时间跟不上（持续溢出或发送超时）的连接会被断开。
+    """
+    
+    RESYNC_KEY = ("resync",)
+    
+    def __init__(self, websocket: WebSocket, stats: Dict, on_evict=None,
+                 max_queue: int = WS_SEND_QUEUE_SIZE, send_timeout: float = WS_SEND_TIMEOUT,
+                 slow_timeout: float = WS_SLOW_CONSUMER_TIMEOUT):
+        self.websocket = websocket
+        self.stats = stats  # 所有连接共享的计数器
+        self.on_evict = on_evict
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.slow_timeout = slow_timeout
+        self._queue: "OrderedDict[Any, Tuple[Optional[int], str]]" = OrderedDict()
+        self._ready = asyncio.Event()
+        self._seq = itertools.count()
+        self._overflow_since: Optional[float] = None
+        self._writer: Optional[asyncio.Task] = None
+        self.closed = False
+    
+    def start(self):
+        self._writer = asyncio.create_task(self._run())
+    
+    def enqueue(self, text: str, key: Any = None, seq: Optional[int] = None):
+        """放入发送队列（不阻塞）；相同key的未发送消息会被新消息替换"""
+        if self.closed:
+            return
+        if key is not None and key in self._queue:
+            # 替换后移到队尾，保证队列始终按seq递增发送（客户端据此断线续传）
+            self._queue[key] = (seq, text)
+            self._queue.move_to_end(key)
+            self.stats["coalesced"] += 1
+            return
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                task_id TEXT PRIMARY KEY,
-                status TEXT NOT NULL,
-                progress REAL DEFAULT 0,
-                message TEXT DEFAULT '',
-                created_at TEXT NOT NULL,
-                completed_at TEXT,
-                result_url TEXT,
-                result_urls TEXT,
-                error TEXT,
-                request_data TEXT,
-                batch_name TEXT
-            )
-        ''')
+        self._queue[key if key is not None else ("msg", next(self._seq))] = (seq, text)
+        self.stats["queued"] += 1
         
-        # 检查并添加result_urls字段（数据库迁移）
-        try:
-            cursor.execute("SELECT result_urls FROM tasks LIMIT 1")
-        except sqlite3.OperationalError:
-            # 字段不存在，添加它
-            cursor.execute("ALTER TABLE tasks ADD COLUMN result_urls TEXT")
-            conn.commit()
-            logger.info("已添加result_urls字段到数据库")
-        
-        conn.commit()
-        conn.close()
+        if len(self._queue) > self.max_queue:
+            self._drop_oldest()
+            now = time.monotonic()
+            if self._overflow_since is None:
+                self._overflow_since = now
+            elif now - self._overflow_since > self.slow_timeout:
+                self.evict("发送队列持续溢出")
+                return
+        self._ready.set()
     
-    def load_tasks_from_database(self):
-        """从数据库加载所有任务到内存"""
-        conn = sqlite3.connect(DB_PATH)
+    def _drop_oldest(self):
+        """丢弃最旧的消息；丢弃的是带seq的事件时用队首的resync标记缺口"""
+        drop_key = next(key for key in self._queue if key != self.RESYNC_KEY)
+        dropped_seq, _ = self._queue.pop(drop_key)
+        self.stats["dropped"] += 1
+        if dropped_seq is None:
+            return
+        marker = self._queue.get(self.RESYNC_KEY)
+        gap_seq = max(dropped_seq, marker[0]) if marker else dropped_seq
+        self._queue[self.RESYNC_KEY] = (gap_seq, json.dumps({"type": "resync", "data": {"seq": gap_seq}}))
+        self._queue.move_to_end(self.RESYNC_KEY, last=False)
+        if marker is None:
+            self.stats["resyncs"] += 1
+    
+    def discard(self, key: Any):
+        """撤回尚未发送的消息"""
+        self._queue.pop(key, None)
+    
+    def pending(self) -> int:
+        return len(self._queue)
+    
+    async def _run(self):
+        try:
+            while True:
+                if not self._queue:
+                    self._overflow_since = None  # 已追上，重置溢出计时
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                _, (seq, text) = self._queue.popitem(last=False)
+                await asyncio.wait_for(self._send(seq, text), self.send_timeout)
+                self.stats["sent"] += 1
+        except asyncio.TimeoutError:
+            self.evict("发送超时")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 连接已断开，由接收循环负责清理
+            self.closed = True
+    
+    async def _send(self, seq: Optional[int], text: str):
+        await self.websocket.send_text(text)
+    
+    def evict(self, reason: str):
+        """断开跟不上的客户端"""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self.stats["evicted"] += 1
+        logger.warning(f"⚠️ 断开慢速WebSocket客户端（{reason}）")
+        if self.on_evict:
+            self.on_evict(self)
+        asyncio.create_task(self._close_socket())
+    
+    async def _close_socket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1013), self.send_timeout)
+        except Exception:
+            pass
+    
+    async def close(self):
+        self.closed = True
+        self._queue.clear()
+        if self._writer and not self._writer.done() and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+
+class EventStreamClient(WebSocketClient):
+    """SSE（Server-Sent Events）连接的发送端
+
+    复用 WebSocketClient 的发送队列、合并和慢客户端处理，只是把消息写成SSE帧交给响应流。
+    """
+    
+    def __init__(self, stats: Dict, on_evict=None, **kwargs):
+        super().__init__(None, stats, on_evict=on_evict, **kwargs)
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=1)
+    
+    async def _send(self, seq: Optional[int], text: str):
+        frame = f"data: {text}\n\n"
+        if seq is not None:
+            frame = f"id: {seq}\n" + frame
+        await self._outbox.put(frame)
+    
+    async def _close_socket(self):
+        try:
+            self._outbox.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+    
+    async def frames(self):
+        """响应流：逐帧输出，空闲时发送心跳注释"""
+        while not self.closed:
+            try:
+                frame = await asyncio.wait_for(self._outbox.get(), SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if frame is None:
+                break
+            yield frame
+
+class TaskEventLog:
+    """最近推送事件的环形缓冲
+
+    每个事件有全局单调递增的序号（以启动时间为基数，重启后也不会回退），
+    客户端断线重连时带上最后收到的序号，只补发之后的事件。
+    """
+    
+    def __init__(self, max_size: int = EVENT_BUFFER_SIZE):
+        self._events: deque = deque(maxlen=max_size)  # (seq, task_id, batch_name, key, text)
+        self._counter = itertools.count(int(time.time() * 1000) * 1000)
+        self.last_seq = next(self._counter)
+        self._floor = self.last_seq  # 小于等于该序号的事件已不在缓冲中
+    
+    def next_seq(self) -> int:
+        self.last_seq = next(self._counter)
+        return self.last_seq
+    
+    def append(self, seq: int, task: TaskStatus, key: Any, text: str):
+        if len(self._events) == self._events.maxlen:
+            self._floor = self._events[0][0]
+        self._events.append((seq, task.task_id, task.batch_name, key, text))
+    
+    def since(self, seq: int) -> Optional[List[tuple]]:
+        """返回序号大于seq的事件；seq已超出缓冲范围（或来自上一次启动）时返回None"""
+        if seq < self._floor or seq > self.last_seq:
+            return None
+        return [event for event in self._events if event[0] > seq]
+    
+    def get_stats(self) -> Dict:
+        return {
+            "buffered": len(self._events),
+            "last_seq": self.last_seq
+        }
+
+class TaskSubscriptions:
+    """WebSocket订阅索引
+
+    按主题索引订阅者：全部任务、指定任务ID、指定批次名称。
+    推送时只查找与该任务相关的订阅者，开销与关注者数量成正比，而不是连接数 × 任务数。
+    """
+    
+    def __init__(self):
+        self.all_subscribers: set = set()
+        self.by_task: Dict[str, set] = {}
+        self.by_batch: Dict[str, set] = {}
+        self._topics: Dict[WebSocketClient, Dict[str, set]] = {}  # 每个连接订阅了哪些主题，断开时用于清理
+        self.send_stats = {"queued": 0, "sent": 0, "coalesced": 0, "dropped": 0, "resyncs": 0, "evicted": 0}
+    
+    def add_connection(self, client: WebSocketClient, subscribe_all: bool = True):
+        self._topics[client] = {"task_ids": set(), "batch_names": set()}
+        if subscribe_all:
+            self.all_subscribers.add(client)
+    
+    def remove_connection(self, client: WebSocketClient):
+        topics = self._topics.pop(client, None)
+        self.all_subscribers.discard(client)
+        if topics:
+            self._discard(self.by_task, topics["task_ids"], client)
+            self._discard(self.by_batch, topics["batch_names"], client)
+    
+    def subscribe(self, client: WebSocketClient, task_ids: List[str] = (), batch_names: List[str] = (), all: bool = False):
+        topics = self._topics.get(client)
+        if topics is None:
+            return
+        if all:
+            self.all_subscribers.add(client)
+        for task_id in task_ids:
+            self.by_task.setdefault(task_id, set()).add(client)
+            topics["task_ids"].add(task_id)
+        for batch_name in batch_names:
+            self.by_batch.setdefault(batch_name, set()).add(client)
+            topics["batch_names"].add(batch_name)
+    
+    def unsubscribe(self, client: WebSocketClient, task_ids: List[str] = (), batch_names: List[str] = (), all: bool = False):
+        topics = self._topics.get(client)
+        if topics is None:
+            return
+        if all:
+            self.all_subscribers.discard(client)
+        self._discard(self.by_task, task_ids, client)
+        self._discard(self.by_batch, batch_names, client)
+        topics["task_ids"].difference_update(task_ids)
+        topics["batch_names"].difference_update(batch_names)
+    
+    @staticmethod
+    def _discard(index: Dict[str, set], keys, client: WebSocketClient):
+        for key in list(keys):
+            subscribers = index.get(key)
+            if subscribers is None:
+                continue
+            subscribers.discard(client)
+            if not subscribers:
+                del index[key]
+    
+    def describe(self, client: WebSocketClient) -> Dict:
+        """当前连接的订阅情况（回复给客户端）"""
+        topics = self._topics.get(client, {"task_ids": set(), "batch_names": set()})
+        return {
+            "all": client in self.all_subscribers,
+            "task_ids": sorted(topics["task_ids"]),
+            "batch_names": sorted(topics["batch_names"])
+        }
+    
+    def wants(self, client: WebSocketClient, task_id: str, batch_name: Optional[str]) -> bool:
+        """该连接是否关注这个任务（补发历史事件时使用）"""
+        if client in self.all_subscribers:
+            return True
+        topics = self._topics.get(client)
+        if topics is None:
+            return False
+        return task_id in topics["task_ids"] or (batch_name is not None and batch_name in topics["batch_names"])
+    
+    def recipients(self, task: TaskStatus) -> set:
+        """关注该任务的所有连接"""
+        recipients = set(self.all_subscribers)
+        recipients.update(self.by_task.get(task.task_id, ()))
+        if task.batch_name:
+            recipients.update(self.by_batch.get(task.batch_name, ()))
+        return recipients
+    
+    def __len__(self) -> int:
+        return len(self._topics)
+    
+    def get_stats(self) -> Dict:
+        return {
+            "connections": len(self._topics),
+            "all_subscribers": len(self.all_subscribers),
+            "task_topics": len(self.by_task),
+            "batch_topics": len(self.by_batch),
+            "pending_messages": sum(client.pending() for client in self._topics),
+            **self.send_stats
+        }
+
+class TaskManager:
+    """任务管理器"""
+    
+    def __init__(self, db_path: str = DB_PATH, progress_flush_interval: float = PROGRESS_FLUSH_INTERVAL):
+        self.db = TaskDatabase(db_path)
+        self.init_database()
+        self.active_tasks = TaskCache()
+        self.subscriptions = TaskSubscriptions()
+        self._last_created_at: Optional[datetime] = None  # 上一个任务的创建时间，保证created_at严格递增
+        # 推送节流：进度变化按任务限频，只发变化的字段；状态转换立即推送完整任务
+        self.progress_event_interval = TASK_PROGRESS_EVENT_INTERVAL
+        self.events = TaskEventLog()
+        self._progress_sent: Dict[str, tuple] = {}  # task_id -> (发送时间, {字段: 已推送的值})
+        self._progress_timers: Dict[str, asyncio.TimerHandle] = {}
+        self.event_stats = {"task_updates": 0, "progress_events": 0, "progress_throttled": 0}
+        # 写缓冲：只有进度/消息变化的任务，定期合并写回数据库
+        self.progress_flush_interval = progress_flush_interval
+        self._dirty_progress: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.write_stats = {
+            "row_writes": 0,
+            "progress_updates": 0,
+            "progress_flushes": 0,
+            "progress_rows_flushed": 0
+        }
+        self.load_tasks_from_database()  # 启动时加载数据库中的任务
+    
+    async def start(self):
+        """启动进度写回任务"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._progress_flush_loop())
+    
+    async def stop(self):
+        """停止进度写回任务并写回剩余进度"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        self.flush_progress()
+    
+    async def _progress_flush_loop(self):
+        while True:
+            await asyncio.sleep(self.progress_flush_interval)
+            self.flush_progress()
+    
+    def flush_progress(self):
+        """把缓冲中的进度合并为一个executemany写入（单个事务）"""
+        if not self._dirty_progress:
+            return
+        rows = []
+        for task_id in self._dirty_progress:
+            task = self.active_tasks.peek(task_id)
+            if task:
+                rows.append((task.progress, task.message, task_id))
+        self._dirty_progress.clear()
+        if not rows:
+            return
+        self.write_stats["progress_flushes"] += 1
+        self.write_stats["progress_rows_flushed"] += len(rows)
+        self.db.submit(lambda conn: conn.executemany(
+            "UPDATE tasks SET progress=?, message=? WHERE task_id=?", rows
+        ))
+    
+    def init_database(self):
+        """初始化数据库"""
+        self.db.call(self._init_schema)
+    
+    def _init_schema(self, conn: sqlite3.Connection):
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT task_id, status, progress, message, created_at, completed_at, 
-                   result_url, result_urls, error, request_data
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                progress REAL DEFAULT 0,
+                message TEXT DEFAULT '',
+                created_at TEXT NOT NULL,
+                completed_at TEXT,
+                result_url TEXT,
+                result_urls TEXT,
+                error TEXT,
+                request_data TEXT,
+                batch_name TEXT
+            )
+        ''')
+        
+        # 检查并添加新增字段（数据库迁移）
+        migrations = [
+            ("result_urls", "TEXT"),
+            ("prompt_id", "TEXT"),
+            ("backend", "TEXT"),
+            ("priority", "INTEGER DEFAULT 0")
+        ]
+        for column, column_type in migrations:
+            try:
+                cursor.execute(f"SELECT {column} FROM tasks LIMIT 1")
+            except sqlite3.OperationalError:
+                # 字段不存在，添加它
+                cursor.execute(f"ALTER TABLE tasks ADD COLUMN {column} {column_type}")
+                logger.info(f"已添加{column}字段到数据库")
+        
+        # 列表查询索引（按创建时间倒序的keyset分页，以及按状态/批次过滤）
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks(created_at, task_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks(status, created_at, task_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_batch_created ON tasks(batch_name, created_at, task_id)")
+    
+    TASK_COLUMNS = """task_id, status, progress, message, created_at, completed_at,
+                   result_url, result_urls, error, request_data, prompt_id, backend, batch_name"""
+
+    def _row_to_task(self, row) -> TaskStatus:
+        """将数据库行转换为TaskStatus对象"""
+        task_id, status, progress, message, created_at, completed_at, result_url, result_urls_json, error, request_data_json, prompt_id, backend, batch_name = row
+        
+        # 解析result_urls JSON
+        result_urls = None
+        if result_urls_json:
+            try:
+                result_urls = json.loads(result_urls_json)
+            except json.JSONDecodeError:
+                logger.warning(f"无法解析任务 {task_id} 的result_urls JSON: {result_urls_json}")
+        
+        # 解析request_data JSON
+        request_data = None
+        if request_data_json:
+            try:
+                request_data = json.loads(request_data_json)
+            except json.JSONDecodeError:
+                logger.warning(f"无法解析任务 {task_id} 的request_data JSON: {request_data_json}")
+        
+        # 创建TaskStatus对象
+        return TaskStatus(
+            task_id=task_id,
+            status=status,
+            progress=progress,
+            message=message or "",
+            created_at=created_at,
+            completed_at=completed_at,
+            result_url=result_url,
+            result_urls=result_urls,
+            error=error,
+            request_data=request_data,
+            prompt_id=prompt_id,
+            backend=backend,
+            batch_name=batch_name
+        )
+    
+    def load_tasks_from_database(self):
+        """从数据库加载最近的任务以及所有未完成的任务到内存"""
+        for row in self.db.call(self._select_startup_rows):
+            task = self._row_to_task(row)
+            self.active_tasks[task.task_id] = task
+        
+        logger.info(f"从数据库加载了 {len(self.active_tasks)} 个任务（未完成 {self.active_tasks.active_count()} 个）")
+    
+    def _select_startup_rows(self, conn: sqlite3.Connection) -> List:
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT {self.TASK_COLUMNS}
             FROM tasks
             ORDER BY created_at DESC
             LIMIT 100  -- 只加载最近100个任务避免内存过载
         ''')
+        rows = cursor.fetchall()
         
-        for row in cursor.fetchall():
-            task_id, status, progress, message, created_at, completed_at, result_url, result_urls_json, error, request_data_json = row
-            
-            # 解析result_urls JSON
-            result_urls = None
-            if result_urls_json:
-                try:
-                    result_urls = json.loads(result_urls_json)
-                except json.JSONDecodeError:
-                    logger.warning(f"无法解析任务 {task_id} 的result_urls JSON: {result_urls_json}")
-            
-            # 解析request_data JSON
-            request_data = None
-            if request_data_json:
-                try:
-                    request_data = json.loads(request_data_json)
-                except json.JSONDecodeError:
-                    logger.warning(f"无法解析任务 {task_id} 的request_data JSON: {request_data_json}")
-            
-            # 创建TaskStatus对象
-            task = TaskStatus(
-                task_id=task_id,
-                status=status,
-                progress=progress,
-                message=message or "",
-                created_at=created_at,
-                completed_at=completed_at,
-                result_url=result_url,
-                result_urls=result_urls,
-                error=error,
-                request_data=request_data
-            )
-            
-            self.active_tasks[task_id] = task
+        # 未完成的任务必须在内存中，重启后才能继续执行/重新关联
+        cursor.execute(f'''
+            SELECT {self.TASK_COLUMNS}
+            FROM tasks
+            WHERE status IN ('pending', 'running')
+        ''')
+        rows.extend(cursor.fetchall())
+        return rows
+    
+    async def get_unfinished_tasks(self) -> List[Dict]:
+        """获取重启前未完成的任务（按创建时间排序），用于恢复执行"""
+        rows = await self.db.run(lambda conn: conn.execute('''
+            SELECT task_id, COALESCE(priority, 0)
+            FROM tasks
+            WHERE status IN ('pending', 'running')
+            ORDER BY created_at ASC
+        ''').fetchall())
         
-        conn.close()
-        logger.info(f"从数据库加载了 {len(self.active_tasks)} 个任务")
+        unfinished = []
+        for task_id, priority in rows:
+            task = self.active_tasks.peek(task_id)
+            if task:
+                unfinished.append({"task": task, "priority": priority})
+        return unfinished
+    
+    def _next_created_at(self) -> str:
+        """分配严格递增的创建时间（同一微秒内创建的任务顺延1微秒）
+
+        /tasks 按 (created_at, task_id) 分页排序，时间相同时会按随机的task_id排列，打乱提交顺序。
+        """
+        now = datetime.now()
+        if self._last_created_at is not None and now <= self._last_created_at:
+            now = self._last_created_at + timedelta(microseconds=1)
+        self._last_created_at = now
+        return now.isoformat(timespec="microseconds")
     
-    def create_task(self, request_data: Dict, batch_name: Optional[str] = None) -> str:
+    def create_task(self, request_data: Dict, batch_name: Optional[str] = None, priority: int = 0) -> str:
         """创建新任务"""
         task_id = str(uuid.uuid4())
-        now = datetime.now().isoformat()
+        now = self._next_created_at()
         
         task = TaskStatus(
             task_id=task_id,
             status="pending",
             progress=0,
             message="任务已创建",
-            created_at=now
+            created_at=now,
+            request_data=request_data,
+            batch_name=batch_name
         )
         
         self.active_tasks[task_id] = task
         
-        # 保存到数据库
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        # 保存到数据库（交给写线程，不阻塞事件循环）
+        params = (task_id, "pending", 0, "任务已创建", now, json.dumps(request_data), batch_name, priority)
+        self.db.submit(lambda conn: conn.execute('''
+            INSERT INTO tasks (task_id, status, progress, message, created_at, request_data, batch_name, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', params))
         
-        cursor.execute('''
-            INSERT INTO tasks (task_id, status, progress, message, created_at, request_data, batch_name)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (task_id, "pending", 0, "任务已创建", now, json.dumps(request_data), batch_name))
+        return task_id
+    
+    async def create_tasks(self, items: List[Tuple[Dict, Optional[str]]], priority: int = 0) -> List[str]:
+        """批量创建任务：内存状态一次性创建，数据库用executemany在同一事务中插入"""
+        task_ids = []
+        rows = []
         
-        conn.commit()
-        conn.close()
+        for request_data, batch_name in items:
+            task_id = str(uuid.uuid4())
+            now = self._next_created_at()
+            self.active_tasks[task_id] = TaskStatus(
+                task_id=task_id,
+                status="pending",
+                progress=0,
+                message="任务已创建",
+                created_at=now,
+                request_data=request_data,
+                batch_name=batch_name
+            )
+            task_ids.append(task_id)
+            rows.append((task_id, "pending", 0, "任务已创建", now, json.dumps(request_data), batch_name, priority))
         
-        return task_id
+        # 等待事务提交后再返回，保证返回的任务ID已经持久化
+        await self.db.run(lambda conn: conn.executemany('''
+            INSERT INTO tasks (task_id, status, progress, message, created_at, request_data, batch_name, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows))
+        
+        return task_ids
     
     def update_task(self, task_id: str, status: Optional[str] = None, 
                    progress: Optional[float] = None, message: Optional[str] = None,
                    result_url: Optional[str] = None, result_urls: Optional[List[str]] = None,
-                   error: Optional[str] = None):
-        """更新任务状态"""
-        if task_id not in self.active_tasks:
+                   error: Optional[str] = None, prompt_id: Optional[str] = None,
+                   backend: Optional[str] = None, queue_position: Optional[int] = None):
+        """更新任务状态（queue_position=0 表示已开始执行，清除排队位置）"""
+        task = self.active_tasks.peek(task_id)
+        if task is None:
             return
         
-        task = self.active_tasks[task_id]
-        
         if status:
             task.status = status
         if progress is not None:
@@ -370,590 +2140,1242 @@ class TaskManager:
             task.result_urls = result_urls
         if error:
             task.error = error
+        if prompt_id:
+            task.prompt_id = prompt_id
+        if backend:
+            task.backend = backend
+        if queue_position is not None:
+            task.queue_position = queue_position or None
         
         if status in ["completed", "failed"]:
             task.completed_at = datetime.now().isoformat()
+            task.queue_position = None
+        if status:
+            self.active_tasks.put(task)  # 状态变化后重新归类（已结束的任务可被淘汰）
         
-        # 更新数据库
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        # 只有进度/消息变化时先缓冲在内存，由后台定期合并写回；
+        # 状态转换、结果、错误以及prompt_id/节点信息立即写入
+        durable = any(value for value in (status, result_url, result_urls, error, prompt_id, backend))
+        if not durable:
+            self.write_stats["progress_updates"] += 1
+            self._dirty_progress.add(task_id)
+        else:
+            self._write_task_row(task)
         
+        # 通知WebSocket客户端
+        self.broadcast_update(task, progress_only=not durable)
+    
+    def _write_task_row(self, task: TaskStatus):
+        """立即把任务整行写入数据库（交给写线程，不阻塞事件循环）"""
+        self._dirty_progress.discard(task.task_id)
+        self.write_stats["row_writes"] += 1
+        task_id = task.task_id
         # 将result_urls转换为JSON字符串存储
         result_urls_json = json.dumps(task.result_urls) if task.result_urls else None
-        
-        cursor.execute('''
-            UPDATE tasks SET status=?, progress=?, message=?, completed_at=?, result_url=?, error=?, result_urls=?
+        params = (task.status, task.progress, task.message, task.completed_at,
+                  task.result_url, task.error, result_urls_json, task.prompt_id, task.backend, task_id)
+        self.db.submit(lambda conn: conn.execute('''
+            UPDATE tasks SET status=?, progress=?, message=?, completed_at=?, result_url=?, error=?, result_urls=?,
+                             prompt_id=?, backend=?
             WHERE task_id=?
-        ''', (task.status, task.progress, task.message, task.completed_at, 
-              task.result_url, task.error, result_urls_json, task_id))
+        ''', params))
+    
+    def get_write_stats(self) -> Dict:
+        stats = dict(self.write_stats)
+        stats["progress_pending"] = len(self._dirty_progress)
+        return stats
+    
+    def broadcast_update(self, task: TaskStatus, progress_only: bool = False):
+        """推送任务更新给订阅了该任务（或其批次/全部）的客户端
+
+        状态转换等重要变化立即推送完整任务（task_update）；
+        只有进度/消息变化时按任务限频，推送只含变化字段的 task_progress（以最新值为准）。
+        两种消息都带有全局单调递增的 seq，客户端可据此丢弃过期消息，断线重连时据此补发。
+        """
+        if progress_only:
+            self._schedule_progress_event(task)
+        else:
+            self._send_task_update(task)
+    
+    def _send_task_update(self, task: TaskStatus):
+        task_id = task.task_id
+        timer = self._progress_timers.pop(task_id, None)
+        if timer:
+            timer.cancel()  # 完整任务已包含最新进度
         
-        conn.commit()
-        conn.close()
+        self._progress_sent[task_id] = (time.monotonic(), self._progress_fields(task))
+        if task.status in TaskCache.TERMINAL_STATUSES:
+            self._progress_sent.pop(task_id, None)
         
-        # 通知WebSocket客户端
-        asyncio.create_task(self.broadcast_update(task))
+        # 每次更新只序列化一次；同一任务未发出的旧更新会被合并
+        seq = self.events.next_seq()
+        text = json.dumps({
+            "type": "task_update",
+            "seq": seq,
+            "data": task.dict()
+        })
+        self.events.append(seq, task, task_id, text)
+        self.event_stats["task_updates"] += 1
+        for client in self.subscriptions.recipients(task):
+            self.deliver(client, seq, task_id, text)
     
-    async def broadcast_update(self, task: TaskStatus):
-        """广播任务更新"""
-        if not self.websocket_connections:
+    def _schedule_progress_event(self, task: TaskStatus):
+        task_id = task.task_id
+        if task_id in self._progress_timers:
+            # 已有待发送的进度，发送时会取最新值
+            self.event_stats["progress_throttled"] += 1
             return
         
-        message = {
-            "type": "task_update",
-            "data": task.dict()
-        }
+        last = self._progress_sent.get(task_id)
+        delay = 0 if last is None else self.progress_event_interval - (time.monotonic() - last[0])
+        if delay <= 0:
+            self._send_progress_event(task_id)
+        else:
+            self.event_stats["progress_throttled"] += 1
+            self._progress_timers[task_id] = asyncio.get_running_loop().call_later(
+                delay, self._send_progress_event, task_id
+            )
+    
+    def _send_progress_event(self, task_id: str):
+        self._progress_timers.pop(task_id, None)
+        task = self.active_tasks.peek(task_id)
+        if task is None or task.status in TaskCache.TERMINAL_STATUSES:
+            return
         
-        disconnected = []
-        for ws in self.websocket_connections:
-            try:
-                await ws.send_text(json.dumps(message))
-            except:
-                disconnected.append(ws)
+        last = self._progress_sent.get(task_id)
+        fields = self._progress_fields(task)
+        delta = {"task_id": task_id}
+        for field, value in fields.items():
+            if last is None or last[1].get(field) != value:
+                delta[field] = value
+        self._progress_sent[task_id] = (time.monotonic(), fields)
+        if len(delta) == 1:
+            return
         
-        # 移除断开的连接
-        for ws in disconnected:
-            self.websocket_connections.remove(ws)
+        seq = self.events.next_seq()
+        text = json.dumps({
+            "type": "task_progress",
+            "seq": seq,
+            "data": delta
+        })
+        self.events.append(seq, task, ("progress", task_id), text)
+        self.event_stats["progress_events"] += 1
+        for client in self.subscriptions.recipients(task):
+            self.deliver(client, seq, ("progress", task_id), text)
+    
+    @staticmethod
+    def _progress_fields(task: TaskStatus) -> Dict:
+        """task_progress 消息可能包含的字段"""
+        return {"progress": task.progress, "message": task.message, "queue_position": task.queue_position}
     
-    def get_task(self, task_id: str) -> Optional[TaskStatus]:
-        """获取任务状态"""
-        return self.active_tasks.get(task_id)
+    @staticmethod
+    def deliver(client: WebSocketClient, seq: int, key: Any, text: str):
+        """放入客户端发送队列；完整任务更新会撤回该任务尚未发出的进度消息"""
+        if not isinstance(key, tuple):
+            client.discard(("progress", key))
+        client.enqueue(text, key=key, seq=seq)
     
-    def get_all_tasks(self) -> List[TaskStatus]:
-        """获取所有任务"""
-        return list(self.active_tasks.values())
+    def attach_client(self, client: WebSocketClient, subscribe_all: bool = True,
+                      task_ids: List[str] = (), batch_names: List[str] = (), since: Optional[int] = None):
+        """注册连接并按需补发断线期间的事件
 
-def create_workflow(request: GenerationRequest) -> Dict:
-    """根据请求创建ComfyUI工作流（自适应FLUX/Qwen）"""
-    seed = request.seed if request.seed else int(time.time() * 1000000) % 1000000000
+        先告知客户端当前序号；since 已超出缓冲范围时发送 resync，客户端应重新拉取 /tasks。
+        注册和补发之间没有await，补发的事件一定排在之后的实时事件前面。
+        """
+        self.subscriptions.add_connection(client, subscribe_all=subscribe_all)
+        self.subscriptions.subscribe(client, task_ids, batch_names)
+        
+        if since is None:
+            client.enqueue(json.dumps({"type": "connected", "data": {"seq": self.events.last_seq}}))
+            return
+        
+        events = self.events.since(since)
+        if events is not None:
+            events = [event for event in events if self.subscriptions.wants(client, event[1], event[2])]
+        if events is None or len(events) > client.max_queue:
+            client.enqueue(json.dumps({"type": "resync", "data": {"seq": self.events.last_seq}}))
+            return
+        
+        client.enqueue(json.dumps({"type": "connected", "data": {"seq": self.events.last_seq, "replayed": len(events)}}))
+        for seq, _, _, key, text in events:
+            self.deliver(client, seq, key, text)
     
-    # 如果没有输入图片，使用Qwen文生图工作流
-    if not request.input_image:
-        return create_qwen_text_to_image_workflow(request, seed)
-    else:
-        return create_qwen_workflow(request, seed)
-
-def create_qwen_text_to_image_workflow(request: GenerationRequest, seed: int) -> Dict:
-    """创建Qwen文生图工作流（基于新JSON配置）"""
-    workflow = {
-        "3": {
-            "inputs": {
-                "seed": seed,
-                "steps": request.steps,
-                "cfg": request.cfg,
-                "sampler_name": "euler_cfg_pp",
-                "scheduler": "sgm_uniform",
-                "denoise": 1,
-                "model": ["66", 0],
-                "positive": ["6", 0],
-                "negative": ["7", 0],
-                "latent_image": ["58", 0]
-            },
-            "class_type": "KSampler",
-            "_meta": {"title": "K采样器"}
-        },
-        "6": {
-            "inputs": {
-                "text": request.prompt,
-                "clip": ["38", 0]
-            },
-            "class_type": "CLIPTextEncode",
-            "_meta": {"title": "CLIP Text Encode (Positive Prompt)"}
-        },
-        "7": {
-            "inputs": {
-                "text": request.negative_prompt or "变形脸，奇怪五官，夸张动漫，大头，塑料皮肤，3D渲染，超现实主义皮肤，恐怖眼神，低质量，畸形，额外的手，额外的手指，奇怪光影，避免高饱和亮色，避免塑料感的鲜艳颜色",
-                "clip": ["38", 0]
-            },
-            "class_type": "CLIPTextEncode",
-            "_meta": {"title": "CLIP Text Encode (Negative Prompt)"}
-        },
-        "8": {
-            "inputs": {
-                "samples": ["3", 0],
-                "vae": ["39", 0]
-            },
-            "class_type": "VAEDecode",
-            "_meta": {"title": "VAE解码"}
-        },
-        "37": {
-            "inputs": {
-                "unet_name": "Qwen-Image_ComfyUI/qwen_image_bf16.safetensors",
-                "weight_dtype": "default"
-            },
-            "class_type": "UNETLoader",
-            "_meta": {"title": "UNet加载器"}
-        },
-        "38": {
-            "inputs": {
-                "clip_name": "qwen_2.5_vl_7b_fp8_scaled.safetensors",
-                "type": "qwen_image",
-                "device": "default"
-            },
-            "class_type": "CLIPLoader",
-            "_meta": {"title": "加载CLIP"}
-        },
-        "39": {
-            "inputs": {
-                "vae_name": "qwen_image_vae.safetensors"
-            },
-            "class_type": "VAELoader",
-            "_meta": {"title": "加载VAE"}
-        },
-        "58": {
-            "inputs": {
-                "width": request.width,
-                "height": request.height,
-                "batch_size": request.batch_size
-            },
-            "class_type": "EmptySD3LatentImage",
-            "_meta": {"title": "空Latent图像（SD3）"}
-        },
-        "60": {
-            "inputs": {
-                "filename_prefix": "ComfyUI",
-                "images": ["8", 0]
-            },
-            "class_type": "SaveImage",
-            "_meta": {"title": "保存图像"}
-        },
-        "66": {
-            "inputs": {
-                "shift": 3,
-                "model": ["73", 0]
-            },
-            "class_type": "ModelSamplingAuraFlow",
-            "_meta": {"title": "采样算法（AuraFlow）"}
-        },
-        "73": {
-            "inputs": {
-                "lora_name": "Qwen-Image-Lightning/Qwen-Image-Lightning-8steps-V1.0.safetensors",
-                "strength_model": 1,
-                "model": ["37", 0]
-            },
-            "class_type": "LoraLoaderModelOnly",
-            "_meta": {"title": "LoRA加载器（仅模型）"}
-        }
+    # /tasks 可选返回字段 -> 数据库列
+    QUERY_FIELDS = {
+        "task_id": "task_id",
+        "status": "status",
+        "progress": "progress",
+        "message": "message",
+        "created_at": "created_at",
+        "completed_at": "completed_at",
+        "result_url": "result_url",
+        "result_urls": "result_urls",
+        "error": "error",
+        "request_data": "request_data",
+        "prompt_id": "prompt_id",
+        "backend": "backend",
+        "batch_name": "batch_name"
     }
-    return workflow
-
-def create_flux_workflow(request: GenerationRequest, seed: int) -> Dict:
-    """创建FLUX文生图工作流"""
-    workflow = {
-        "1": {
-            "inputs": {
-                "seed": seed,
-                "steps": request.steps,
-                "cfg": request.cfg,
-                "sampler_name": "dpmpp_2m_sde",
-                "scheduler": "simple", 
-                "denoise": 1,
-                "model": ["2", 0],
-                "positive": ["13", 0],
-                "negative": ["4", 0],
-                "latent_image": ["5", 0]
-            },
-            "class_type": "KSampler",
-            "_meta": {"title": "K采样器"}
-        },
-        "2": {
-            "inputs": {
-                "unet_name": "flux1-dev-fp8.safetensors",
-                "weight_dtype": "fp8_e4m3fn"
-            },
-            "class_type": "UNETLoader",
-            "_meta": {"title": "UNet加载器"}
-        },
-        "4": {
-            "inputs": {
-                "text": request.negative_prompt,
-                "clip": ["9", 0]
-            },
-            "class_type": "CLIPTextEncode",
-            "_meta": {"title": "CLIP文本编码"}
-        },
-        "5": {
-            "inputs": {
-                "width": request.width,
-                "height": request.height,
-                "batch_size": request.batch_size
-            },
-            "class_type": "EmptyLatentImage",
-            "_meta": {"title": "空Latent图像"}
-        },
-        "6": {
-            "inputs": {
-                "samples": ["1", 0],
-                "vae": ["7", 0]
-            },
-            "class_type": "VAEDecode",
-            "_meta": {"title": "VAE解码"}
-        },
-        "7": {
-            "inputs": {
-                "vae_name": "ae.safetensors"
-            },
-            "class_type": "VAELoader",
-            "_meta": {"title": "加载VAE"}
-        },
-        "8": {
-            "inputs": {
-                "images": ["6", 0]
-            },
-            "class_type": "PreviewImage",
-            "_meta": {"title": "预览图像"}
-        },
-        "9": {
-            "inputs": {
-                "clip_name1": "clip_l.safetensors",
-                "clip_name2": "t5xxl_fp8_e4m3fn.safetensors",
-                "type": "flux",
-                "device": "default"
-            },
-            "class_type": "DualCLIPLoader",
-            "_meta": {"title": "双CLIP加载器"}
-        },
-        "13": {
-            "inputs": {
-                "text": request.prompt,
-                "clip": ["9", 0]
-            },
-            "class_type": "CLIPTextEncode",
-            "_meta": {"title": "CLIP文本编码"}
+    JSON_FIELDS = {"result_urls", "request_data"}
+    
+    async def query_tasks(self, statuses: Optional[List[str]] = None, batch_name: Optional[str] = None,
+                          created_after: Optional[str] = None, created_before: Optional[str] = None,
+                          limit: int = TASKS_PAGE_DEFAULT, after: Optional[Tuple[str, str]] = None,
+                          fields: Optional[List[str]] = None) -> Tuple[List[Dict], Optional[Tuple[str, str]]]:
+        """按条件分页查询任务（按created_at倒序，keyset分页）
+
+        after 为上一页最后一条的 (created_at, task_id)；返回 (本页任务, 下一页游标键)。
+        """
+        fields = fields or list(self.QUERY_FIELDS)
+        columns = ["task_id", "created_at"] + [self.QUERY_FIELDS[f] for f in fields if f not in ("task_id", "created_at")]
+        
+        conditions = []
+        params: List[Any] = []
+        if statuses:
+            conditions.append(f"status IN ({','.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if batch_name:
+            conditions.append("batch_name = ?")
+            params.append(batch_name)
+        if created_after:
+            conditions.append("created_at >= ?")
+            params.append(created_after)
+        if created_before:
+            conditions.append("created_at < ?")
+            params.append(created_before)
+        if after:
+            conditions.append("(created_at < ? OR (created_at = ? AND task_id < ?))")
+            params.extend([after[0], after[0], after[1]])
+        
+        sql = f"SELECT {', '.join(columns)} FROM tasks"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY created_at DESC, task_id DESC LIMIT ?"
+        params.append(limit + 1)  # 多取一条用于判断是否还有下一页
+        
+        rows = await self.db.run(lambda conn: conn.execute(sql, params).fetchall())
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        tasks = []
+        for row in rows:
+            record = dict(zip(columns, row))
+            # 运行中任务的进度只在内存中是最新的（写缓冲），用内存值覆盖
+            live = self.active_tasks.peek(record["task_id"])
+            if live is not None and live.status not in ("completed", "failed"):
+                live_data = live.dict()
+                for field in fields:
+                    if field in live_data:
+                        record[field] = live_data[field]
+            else:
+                for field in self.JSON_FIELDS:
+                    if field in record and isinstance(record[field], str):
+                        try:
+                            record[field] = json.loads(record[field])
+                        except json.JSONDecodeError:
+                            record[field] = None
+            tasks.append({field: record.get(self.QUERY_FIELDS[field]) for field in fields})
+        
+        next_key = (rows[-1][1], rows[-1][0]) if has_more and rows else None
+        return tasks, next_key
+    
+    async def get_task(self, task_id: str) -> Optional[TaskStatus]:
+        """获取任务状态（缓存未命中时从数据库加载）"""
+        task = self.active_tasks.get(task_id)
+        if task is not None:
+            return task
+        
+        row = await self.db.run(lambda conn: conn.execute(
+            f"SELECT {self.TASK_COLUMNS} FROM tasks WHERE task_id = ?", (task_id,)
+        ).fetchone())
+        if row is None:
+            return None
+        
+        # 加载期间任务可能已被其他协程放入缓存，以缓存中的对象为准
+        task = self.active_tasks.peek(task_id)
+        if task is None:
+            task = self._row_to_task(row)
+            self.active_tasks.put(task)
+        return task
+
+class WorkflowTemplate:
+    """工作流模板：ComfyUI API格式的工作流 + 参数绑定规格
+
+    加载时把绑定编译成 (节点ID, 输入名) 列表并校验节点存在；
+    生成工作流时只浅拷贝顶层字典，被修改的节点才复制（写时复制），不再每次重建整个嵌套字典。
+    """
+    
+    def __init__(self, spec: Dict, workflow: Dict, source: str = ""):
+        self.id: str = spec["id"]
+        self.name: str = spec.get("name", self.id)
+        self.source = source
+        self.workflow = workflow
+        self.bindings: Dict[str, List[Tuple[str, str]]] = {
+            field: [self.parse_target(target) for target in (targets if isinstance(targets, list) else [targets])]
+            for field, targets in (spec.get("bindings") or {}).items()
         }
-    }
-    return workflow
-
-def create_qwen_workflow(request: GenerationRequest, seed: int) -> Dict:
-    """创建Qwen图生图工作流"""
-    input_image = request.input_image
-    
-    workflow = {
-        "60": {
-            "inputs": {
-                "filename_prefix": "ComfyUI",
-                "images": ["115:8", 0]
-            },
-            "class_type": "SaveImage",
-            "_meta": {"title": "保存图像"}
-        },
-        "78": {
-            "inputs": {
-                "image": input_image
-            },
-            "class_type": "LoadImage",
-            "_meta": {"title": "加载图像"}
-        },
-        "115:75": {
-            "inputs": {
-                "strength": 1,
-                "model": ["115:66", 0]
-            },
-            "class_type": "CFGNorm",
-            "_meta": {"title": "CFGNorm"}
-        },
-        "115:39": {
-            "inputs": {
-                "vae_name": "qwen_image_vae.safetensors"
-            },
-            "class_type": "VAELoader",
-            "_meta": {"title": "加载VAE"}
-        },
-        "115:38": {
-            "inputs": {
-                "clip_name": "qwen_2.5_vl_7b_fp8_scaled.safetensors",
-                "type": "qwen_image",
-                "device": "default"
-            },
-            "class_type": "CLIPLoader",
-            "_meta": {"title": "加载CLIP"}
-        },
-        "115:37": {
-            "inputs": {
-                "unet_name": "Qwen-Image-Edit_ComfyUI/qwen_image_edit_2509_fp8_e4m3fn.safetensors",
-                "weight_dtype": "default"
-            },
-            "class_type": "UNETLoader",
-            "_meta": {"title": "UNet加载器"}
-        },
-        "115:110": {
-            "inputs": {
-                "prompt": request.negative_prompt,
-                "clip": ["115:38", 0],
-                "vae": ["115:39", 0],
-                "image1": ["115:93", 0]
-            },
-            "class_type": "TextEncodeQwenImageEditPlus",
-            "_meta": {"title": "TextEncodeQwenImageEditPlus"}
-        },
-        "115:93": {
-            "inputs": {
-                "upscale_method": "lanczos",
-                "megapixels": 1,
-                "image": ["78", 0]
-            },
-            "class_type": "ImageScaleToTotalPixels",
-            "_meta": {"title": "缩放图像（像素）"}
-        },
-        "115:66": {
-            "inputs": {
-                "shift": 3,
-                "model": ["115:89", 0]
-            },
-            "class_type": "ModelSamplingAuraFlow",
-            "_meta": {"title": "采样算法（AuraFlow）"}
-        },
-        "115:8": {
-            "inputs": {
-                "samples": ["115:3", 0],
-                "vae": ["115:39", 0]
-            },
-            "class_type": "VAEDecode",
-            "_meta": {"title": "VAE解码"}
-        },
-        "115:88": {
-            "inputs": {
-                "pixels": ["115:93", 0],
-                "vae": ["115:39", 0]
-            },
-            "class_type": "VAEEncode",
-            "_meta": {"title": "VAE编码"}
-        },
-        "115:112": {
-            "inputs": {
-                "width": request.width,
-                "height": request.height,
-                "batch_size": request.batch_size
-            },
-            "class_type": "EmptySD3LatentImage",
-            "_meta": {"title": "空Latent图像（SD3）"}
-        },
-        "115:89": {
-            "inputs": {
-                "lora_name": "Qwen-Image-Lightning/Qwen-Image-Lightning-4steps-V1.0.safetensors",
-                "strength_model": 1,
-                "model": ["115:37", 0]
-            },
-            "class_type": "LoraLoaderModelOnly",
-            "_meta": {"title": "LoRA加载器（仅模型）"}
-        },
-        "115:116": {
-            "inputs": {
-                "images": ["115:8", 0]
-            },
-            "class_type": "PreviewImage",
-            "_meta": {"title": "预览图像"}
-        },
-        "115:111": {
-            "inputs": {
-                "prompt": request.prompt,
-                "clip": ["115:38", 0],
-                "vae": ["115:39", 0],
-                "image1": ["115:93", 0]
-            },
-            "class_type": "TextEncodeQwenImageEditPlus",
-            "_meta": {"title": "TextEncodeQwenImageEditPlus"}
-        },
-        "115:3": {
-            "inputs": {
-                "seed": seed,
-                "steps": request.steps,
-                "cfg": request.cfg,
-                "sampler_name": "euler_cfg_pp",
-                "scheduler": "sgm_uniform",
-                "denoise": 0.8,
-                "model": ["115:75", 0],
-                "positive": ["115:111", 0],
-                "negative": ["115:110", 0],
-                "latent_image": ["115:112", 0]
-            },
-            "class_type": "KSampler",
-            "_meta": {"title": "K采样器"}
+        self.keep_default_if_empty = set(spec.get("keep_default_if_empty") or [])
+        self.overrides: List[Tuple[Tuple[str, str], Any]] = [
+            (self.parse_target(target), value) for target, value in (spec.get("overrides") or {}).items()
+        ]
+        # 每个图片槽位是一组节点，第一个是接收图片名的LoadImage；未使用的槽位整组删除
+        self.image_slots: List[List[str]] = [[str(node) for node in slot] for slot in spec.get("image_slots") or []]
+        self.min_images = spec.get("min_images", 0)
+        self.remove_nodes = set(str(node) for node in spec.get("remove_nodes") or [])
+        self.output_nodes: List[str] = [str(node) for node in spec.get("output_nodes") or []]
+        
+        for (node_id, input_name) in [t for targets in self.bindings.values() for t in targets] + [t for t, _ in self.overrides]:
+            if node_id not in workflow:
+                raise ValueError(f"模板 {self.id} 绑定的节点不存在: {node_id}.{input_name}")
+        for node_id in [slot[0] for slot in self.image_slots] + self.output_nodes:
+            if node_id not in workflow:
+                raise ValueError(f"模板 {self.id} 引用的节点不存在: {node_id}")
+        
+        # 预先计算每种图片数量下要删除的节点和悬空的连线
+        self._pruning = {count: self._compile_pruning(count) for count in range(len(self.image_slots) + 1)}
+    
+    @staticmethod
+    def parse_target(target: str) -> Tuple[str, str]:
+        """'节点ID.输入名' -> (节点ID, 输入名)；节点ID本身可能包含点号或冒号，按最后一个点号拆分"""
+        node_id, sep, input_name = str(target).rpartition(".")
+        if not sep or not node_id or not input_name:
+            raise ValueError(f"无效的绑定目标: {target}（应为 节点ID.输入名）")
+        return node_id, input_name
+    
+    def _compile_pruning(self, image_count: int) -> Tuple[set, List[Tuple[str, str]]]:
+        removed = set(self.remove_nodes)
+        for slot in self.image_slots[image_count:]:
+            removed.update(slot)
+        dangling = []
+        for node_id, node in self.workflow.items():
+            if node_id in removed:
+                continue
+            for input_name, value in node.get("inputs", {}).items():
+                if isinstance(value, list) and len(value) == 2 and str(value[0]) in removed:
+                    dangling.append((node_id, input_name))
+        return removed, dangling
+    
+    def render(self, values: Dict[str, Any], images: List[str] = (),
+               overrides: List[Tuple[Tuple[str, str], Any]] = ()) -> Dict:
+        """根据请求参数生成可提交的工作流；overrides在参数绑定之后应用（优先级最高）"""
+        if len(images) < self.min_images:
+            raise ValueError(f"模板 {self.name} 至少需要 {self.min_images} 张输入图片")
+        if len(images) > len(self.image_slots):
+            raise ValueError(f"模板 {self.name} 最多支持 {len(self.image_slots)} 张输入图片")
+        
+        workflow = dict(self.workflow)
+        copied: set = set()
+        
+        def writable_inputs(node_id: str) -> Dict:
+            if node_id not in copied:
+                node = dict(workflow[node_id])
+                node["inputs"] = dict(node.get("inputs", {}))
+                workflow[node_id] = node
+                copied.add(node_id)
+            return workflow[node_id]["inputs"]
+        
+        for (node_id, input_name), value in self.overrides:
+            writable_inputs(node_id)[input_name] = value
+        for field, targets in self.bindings.items():
+            value = values.get(field)
+            if value is None or (value == "" and field in self.keep_default_if_empty):
+                continue
+            for node_id, input_name in targets:
+                writable_inputs(node_id)[input_name] = value
+        for slot, image in zip(self.image_slots, images):
+            writable_inputs(slot[0])["image"] = image
+        
+        removed, dangling = self._pruning[len(images)]
+        for (node_id, input_name), value in overrides:
+            if node_id not in workflow or node_id in removed:
+                raise ValueError(f"覆盖目标节点不存在: {node_id}.{input_name}")
+            writable_inputs(node_id)[input_name] = value
+        for node_id in removed:
+            workflow.pop(node_id, None)
+        for node_id, input_name in dangling:
+            writable_inputs(node_id).pop(input_name, None)
+        return workflow
+    
+    def describe(self) -> Dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "parameters": sorted(self.bindings),
+            "max_images": len(self.image_slots),
+            "min_images": self.min_images,
+            "output_nodes": self.output_nodes
         }
+
+class WorkflowTemplateRegistry:
+    """工作流模板注册表：启动时从模板目录加载所有规格文件（*.json）"""
+    
+    def __init__(self, template_dir: Path = WORKFLOW_TEMPLATE_DIR):
+        self.template_dir = Path(template_dir)
+        self.templates: Dict[str, WorkflowTemplate] = {}
+        self.load()
+    
+    def load(self):
+        templates = {}
+        for spec_path in sorted(self.template_dir.glob("*.json")):
+            try:
+                with open(spec_path, "r", encoding="utf-8") as f:
+                    spec = json.load(f)
+                workflow_path = (spec_path.parent / spec["workflow"]).resolve()
+                with open(workflow_path, "r", encoding="utf-8") as f:
+                    workflow = json.load(f)
+                template = WorkflowTemplate(spec, workflow, source=str(workflow_path))
+                templates[template.id] = template
+            except Exception as e:
+                logger.error(f"❌ 加载工作流模板失败 {spec_path.name}: {e}")
+        self.templates = templates
+        logger.info(f"📐 已加载 {len(templates)} 个工作流模板: {', '.join(templates)}")
+    
+    def get(self, template_id: str) -> WorkflowTemplate:
+        template = self.templates.get(template_id)
+        if template is None:
+            raise KeyError(f"工作流模板不存在: {template_id}")
+        return template
+    
+    def list(self) -> List[Dict]:
+        return [template.describe() for template in self.templates.values()]
+
+# 全局工作流模板注册表
+workflow_templates = WorkflowTemplateRegistry()
+
+def get_request_images(request: GenerationRequest) -> List[str]:
+    """请求的全部输入图片：input_image在前，input_images依次在后，与模板图片槽位一一对应
+
+    同一文件可以出现在多个槽位（上传时按文件去重，只上传一次）。
+    """
+    return ([request.input_image] if request.input_image else []) + list(request.input_images or [])
+
+def get_request_template(request: GenerationRequest) -> WorkflowTemplate:
+    """根据请求选择工作流模板：有输入图片用Qwen图生图，否则用Qwen文生图"""
+    return workflow_templates.get(IMAGE_EDIT_TEMPLATE if get_request_images(request) else TEXT_TO_IMAGE_TEMPLATE)
+
+def create_workflow(request: GenerationRequest, images: Optional[List[str]] = None) -> Dict:
+    """根据请求创建ComfyUI工作流
+
+    images 为已上传到ComfyUI的图片名，依次填入模板的图片槽位（image1..imageN）；
+    默认使用请求中的本地文件名（仅用于校验和进度估算）。
+    """
+    seed = request.seed if request.seed else int(time.time() * 1000000) % 1000000000
+    values = {
+        "prompt": request.prompt,
+        "negative_prompt": request.negative_prompt,
+        "seed": seed,
+        "steps": request.steps,
+        "cfg": request.cfg,
+        "width": request.width,
+        "height": request.height,
+        "batch_size": request.batch_size
     }
+    if images is None:
+        images = get_request_images(request)
+    return get_request_template(request).render(values, images)
+
+def parse_overrides(overrides: Union[List[str], Dict[str, Any]]) -> List[Tuple[Tuple[str, str], Any]]:
+    """解析参数覆盖：'节点ID.输入名=值'（值按JSON解析，失败时作为字符串）或 {'节点ID.输入名': 值}"""
+    if isinstance(overrides, dict):
+        return [(WorkflowTemplate.parse_target(target), value) for target, value in overrides.items()]
+    parsed = []
+    for item in overrides:
+        target, sep, raw = str(item).partition("=")
+        if not sep:
+            raise ValueError(f"无效的参数覆盖: {item}（应为 节点ID.输入名=值）")
+        raw = raw.strip()
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = raw
+        parsed.append((WorkflowTemplate.parse_target(target.strip()), value))
+    return parsed
+
+def merge_workflow_variant(base: WorkflowBatchRequest, variant: WorkflowVariant) -> WorkflowRequest:
+    """公共参数 + 变体参数 -> 单个任务的工作流请求（覆盖项统一规范为字典，后者优先）"""
+    overrides = {f"{node_id}.{input_name}": value
+                 for (node_id, input_name), value in parse_overrides(base.overrides) + parse_overrides(variant.overrides)}
+    return WorkflowRequest(
+        workflow=base.workflow,
+        template_id=base.template_id,
+        params={**base.params, **variant.params},
+        overrides=overrides,
+        images={**base.images, **variant.images},
+        output_nodes=base.output_nodes,
+        batch_name=base.batch_name
+    )
+
+def get_workflow_request_template(request: WorkflowRequest) -> WorkflowTemplate:
+    """已注册模板，或把请求中的API格式工作流包装成无参数绑定的临时模板"""
+    if bool(request.workflow) == bool(request.template_id):
+        raise ValueError("workflow 和 template_id 必须且只能提供一个")
+    if request.template_id:
+        return workflow_templates.get(request.template_id)
+    if request.params:
+        raise ValueError("params 只能用于模板，原始工作流请使用 overrides")
+    for node_id, node in request.workflow.items():
+        if not isinstance(node, dict) or not node.get("class_type") or not isinstance(node.get("inputs", {}), dict):
+            raise ValueError(f"节点 {node_id} 不是有效的API格式节点（需要class_type和inputs）")
+    return WorkflowTemplate({"id": "custom", "name": "自定义工作流"}, request.workflow)
+
+def create_custom_workflow(request: WorkflowRequest, images: Optional[Dict[str, str]] = None) -> Tuple[Dict, List[str]]:
+    """根据工作流请求生成可提交的工作流，返回 (工作流, 输出节点)
+
+    images 为 "节点ID.输入名" -> ComfyUI中的图片名（默认使用请求中的本地文件名，仅用于校验和进度估算）。
+    模板的图片槽位按顺序填充，未填充的槽位照常删除；其余图片输入作为参数覆盖应用。
+    """
+    template = get_workflow_request_template(request)
+    images = dict(request.images if images is None else images)
+    slot_images = []
+    for slot in template.image_slots:
+        image = images.pop(f"{slot[0]}.image", None)
+        if image is None:
+            break
+        slot_images.append(image)
+    overrides = parse_overrides(request.overrides) + [
+        (WorkflowTemplate.parse_target(target), image) for target, image in images.items()
+    ]
+    workflow = template.render(request.params, slot_images, overrides)
+    
+    output_nodes = [str(node) for node in request.output_nodes] or template.output_nodes or [
+        node_id for node_id, node in workflow.items() if node.get("class_type") == "SaveImage"
+    ]
+    missing = [node_id for node_id in output_nodes if node_id not in workflow]
+    if missing:
+        raise ValueError(f"输出节点不存在: {', '.join(missing)}")
+    if not output_nodes:
+        raise ValueError("工作流中没有SaveImage节点，请通过 output_nodes 指定输出节点")
+    return workflow, output_nodes
+
+def stage_workflow_request(stage: PipelineStage, images: Optional[Dict[str, str]] = None) -> WorkflowRequest:
+    return WorkflowRequest(workflow=stage.workflow, template_id=stage.template_id, params=stage.params,
+                           overrides=stage.overrides, images=images or {}, output_nodes=stage.output_nodes)
+
+def get_stage_input(stage: PipelineStage) -> str:
+    """流水线阶段接收上一阶段输出图片的输入（节点ID.输入名）"""
+    if stage.input:
+        WorkflowTemplate.parse_target(stage.input)
+        return stage.input
+    template = get_workflow_request_template(stage_workflow_request(stage))
+    if template.image_slots:
+        return f"{template.image_slots[0][0]}.image"
+    load_nodes = sorted(node_id for node_id, node in template.workflow.items() if node.get("class_type") == "LoadImage")
+    if not load_nodes:
+        raise ValueError(f"阶段 {template.name} 没有LoadImage节点，无法接收上一阶段的图片，请通过 input 指定")
+    return f"{load_nodes[0]}.image"
+
+def comfyui_output_reference(image_info: Dict) -> str:
+    """ComfyUI输出图片 -> LoadImage可直接引用的带注解文件名（如 "ComfyUI_00001_.png [output]"），无需下载再上传"""
+    name = image_info["filename"]
+    if image_info.get("subfolder"):
+        name = f"{image_info['subfolder']}/{name}"
+    return f"{name} [{image_info.get('type', 'output')}]"
+
+TaskRequest = Union[GenerationRequest, WorkflowRequest, PipelineRequest]
+
+def parse_task_request(request_data: Optional[Dict]) -> TaskRequest:
+    """从持久化的request_data恢复任务请求（kind=workflow/pipeline 为任意工作流/流水线任务）"""
+    request_data = request_data or {}
+    if request_data.get("kind") == "workflow":
+        return WorkflowRequest(**request_data)
+    if request_data.get("kind") == "pipeline":
+        return PipelineRequest(**request_data)
+    return GenerationRequest(**request_data)
+
+def build_task_workflow(request: TaskRequest) -> Tuple[Dict, List[str]]:
+    """任务对应的工作流和输出节点（重新关联时用于进度估算和收集结果）"""
+    if isinstance(request, WorkflowRequest):
+        return create_custom_workflow(request)
+    return create_workflow(request), get_request_template(request).output_nodes
+
+class PromptProgressTracker:
+    """把ComfyUI执行事件换算成任务进度
+
+    每个节点按类型分配权重（采样器最重），已缓存/已执行完的节点计入完成部分，
+    正在执行的采样器按 step/max 计入部分权重，最终映射到任务进度的 40%~90%。
+    """
+    
+    START = 40
+    END = 90
+    
+    def __init__(self, workflow: Optional[Dict] = None, start: float = START, end: float = END):
+        self.start = start
+        self.end = end
+        self.class_types = {node_id: node.get("class_type", "") for node_id, node in (workflow or {}).items()}
+        self.weights = {node_id: NODE_PROGRESS_WEIGHTS.get(class_type, 1)
+                        for node_id, class_type in self.class_types.items()}
+        self.total_weight = sum(self.weights.values())
+        self.done_nodes: set = set()
+        self.current_node: Optional[str] = None
+        self.current_fraction = 0.0
+        self.step: Optional[Tuple[int, int]] = None
+    
+    def cached(self, nodes: List[str]):
+        self.done_nodes.update(str(node) for node in nodes or [])
+    
+    def executing(self, node: Optional[str]):
+        if self.current_node is not None:
+            self.done_nodes.add(self.current_node)
+        self.current_node = str(node) if node is not None else None
+        self.current_fraction = 0.0
+        self.step = None
+    
+    def progress(self, node: Optional[str], value: int, maximum: int):
+        if node is not None and str(node) != self.current_node:
+            self.executing(node)
+        self.step = (value, maximum)
+        self.current_fraction = min(1.0, value / maximum) if maximum else 0.0
+    
+    @property
+    def percent(self) -> float:
+        if not self.total_weight:
+            # 不知道工作流结构时只能按采样步数估算
+            fraction = self.current_fraction
+        else:
+            done = sum(self.weights.get(node, 0) for node in self.done_nodes)
+            if self.current_node is not None and self.current_node not in self.done_nodes:
+                done += self.weights.get(self.current_node, 1) * self.current_fraction
+            fraction = min(1.0, done / self.total_weight)
+        return round(self.start + (self.end - self.start) * fraction, 1)
+    
+    @property
+    def message(self) -> str:
+        class_type = self.class_types.get(self.current_node, "")
+        if self.step and (class_type.startswith(("KSampler", "SamplerCustom")) or not class_type):
+            return f"采样中 {self.step[0]}/{self.step[1]}"
+        if "Loader" in class_type:
+            return "加载模型..."
+        if "TextEncode" in class_type:
+            return "编码提示词..."
+        if class_type == "VAEDecode":
+            return "VAE解码..."
+        if class_type.startswith("Save"):
+            return "保存图片..."
+        if class_type:
+            return f"执行 {class_type}..."
+        return "ComfyUI生成中..."
+
+def websocket_delivery_workflow(workflow: Dict, output_nodes: List[str]) -> Optional[Dict]:
+    """把输出节点的SaveImage替换为SaveImageWebsocket（结果图片经WebSocket推送，不写入ComfyUI输出目录）
+
+    有输出节点不是SaveImage时返回None（保持原工作流，经/view下载）。
+    """
+    if not output_nodes:
+        return None
+    rewritten = dict(workflow)
+    for node_id in output_nodes:
+        node = workflow.get(node_id) or {}
+        images = (node.get("inputs") or {}).get("images")
+        if node.get("class_type") != "SaveImage" or images is None:
+            return None
+        rewritten[node_id] = {**node, "class_type": "SaveImageWebsocket", "inputs": {"images": images}}
+    return rewritten
+
+def write_file_atomic(path: Path, data) -> int:
+    """写入同目录下的临时文件后原子重命名（在线程池中执行），返回字节数"""
+    temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        with open(temp_path, "wb") as f:
+            size = f.write(data)
+        os.replace(temp_path, path)
+        return size
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+class WebSocketDeliveryError(Exception):
+    """经WebSocket推送的结果图片不完整（推送期间连接断开或没有收到图片），需要改用/view下载重新生成"""
+
+class WebSocketImageReceiver:
+    """接收SaveImageWebsocket节点推送的结果图片，收到即在线程池中写入输出目录"""
+
+    def __init__(self, task_id: str, image_nodes: List[str]):
+        self.task_id = task_id
+        self.image_nodes = image_nodes
+        self.filenames: List[str] = []
+        self._writes: List[asyncio.Future] = []
+
+    def on_image(self, node_id: str, data: memoryview):
+        extension = detect_image_type(bytes(data[:12]))[0] or ".png"
+        filename = f"{self.task_id}_ws_{len(self.filenames) + 1:02d}{extension}"
+        self.filenames.append(filename)
+        loop = asyncio.get_running_loop()
+        self._writes.append(loop.run_in_executor(None, write_file_atomic, OUTPUT_DIR / filename, data))
+
+    async def save(self) -> List[str]:
+        """等待所有图片写盘完成，返回图片URL列表（按推送顺序）"""
+        sizes = await asyncio.gather(*self._writes)
+        backend_pool.delivery_stats["websocket_images"] += len(sizes)
+        backend_pool.delivery_stats["websocket_bytes"] += sum(sizes)
+        return [f"/images/{filename}" for filename in self.filenames]
+
+    async def discard(self):
+        """删除已写入的图片（改用/view下载重新生成前调用）"""
+        await asyncio.gather(*self._writes, return_exceptions=True)
+        for filename in self.filenames:
+            (OUTPUT_DIR / filename).unlink(missing_ok=True)
+
+async def wait_for_prompt_history(task_id: str, task_manager: TaskManager, comfy: ComfyUIManager, prompt_id: str,
+                                  check_history_first: bool = False, workflow: Optional[Dict] = None,
+                                  progress_range: Optional[Tuple[float, float]] = None, report: bool = True,
+                                  receiver: Optional[WebSocketImageReceiver] = None) -> Dict:
+    """等待已提交的prompt完成并推送进度，返回其history记录
+
+    report=False 时不推送进度（流水线中同一阶段并发的多个prompt只由第一个汇报）。
+    receiver不为空时由它接收SaveImageWebsocket节点推送的图片。
+    超时抛出 asyncio.TimeoutError。
+    """
+    tracker = PromptProgressTracker(workflow, *(progress_range or ()))
+    started = False
     
-    return workflow
+    def on_comfy_event(event_type: str, data: Dict):
+        nonlocal started
+        if event_type == "execution_start":
+            started = True
+            task_manager.update_task(task_id, progress=tracker.start, message="ComfyUI开始执行...", queue_position=0)
+            return
+        if event_type == "execution_cached":
+            tracker.cached(data.get("nodes"))
+        elif event_type == "executing" and data.get("node") is not None:
+            tracker.executing(data.get("node"))
+        elif event_type == "progress":
+            tracker.progress(data.get("node"), data.get("value", 0), data.get("max", 0))
+        else:
+            return
+        if not started:
+            started = True
+            task_manager.update_task(task_id, progress=tracker.percent, message=tracker.message, queue_position=0)
+            return
+        task_manager.update_task(task_id, progress=tracker.percent, message=tracker.message)
+    
+    async def watch_queue_position():
+        # 在ComfyUI中排队期间定期刷新排队位置
+        last_position = None
+        while not started:
+            position = await backend_pool.get_queue_position(comfy.backend, prompt_id)
+            if started or position == 0:
+                return
+            if position and position != last_position:
+                last_position = position
+                task_manager.update_task(task_id, message=f"ComfyUI排队中（第{position}位）", queue_position=position)
+            await asyncio.sleep(QUEUE_POSITION_INTERVAL)
+    
+    # 等待任务完成（由共享WebSocket事件唤醒，断线时回退轮询）
+    queue_watcher = asyncio.create_task(watch_queue_position()) if report else None
+    try:
+        history_entry = await comfy.wait_for_completion(prompt_id, timeout=TASK_TIMEOUT,
+                                                        on_event=on_comfy_event if report else None,
+                                                        check_history_first=check_history_first,
+                                                        image_nodes=receiver.image_nodes if receiver else None,
+                                                        on_image=receiver.on_image if receiver else None)
+    finally:
+        if queue_watcher:
+            queue_watcher.cancel()
+    
+    # 调试日志：记录ComfyUI返回的完整历史数据
+    logger.info(f"📋 任务 {task_id} - ComfyUI历史数据: {json.dumps(history_entry, indent=2, ensure_ascii=False)}")
+    return history_entry
+
+async def wait_for_prompt_images(task_id: str, task_manager: TaskManager, comfy: ComfyUIManager, prompt_id: str,
+                                 check_history_first: bool = False, workflow: Optional[Dict] = None,
+                                 output_nodes: Optional[List[str]] = None, progress_range: Optional[Tuple[float, float]] = None,
+                                 report: bool = True) -> List[Dict]:
+    """等待已提交的prompt完成，返回输出节点的图片信息（filename/subfolder/type）
+
+    超时抛出 asyncio.TimeoutError。
+    """
+    history_entry = await wait_for_prompt_history(task_id, task_manager, comfy, prompt_id,
+                                                  check_history_first=check_history_first, workflow=workflow,
+                                                  progress_range=progress_range, report=report)
+    
+    # 获取生成的图像（支持多张）- 优先使用模板声明的输出节点
+    outputs = history_entry["outputs"]
+    
+    images = []
+    output_node = None
+    for node_id in output_nodes or []:
+        node_images = (outputs.get(node_id) or {}).get("images")
+        if node_images:
+            images.extend(node_images)
+            output_node = node_id if output_node is None else f"{output_node},{node_id}"
+    
+    if not images:
+        # 兼容旧版手写工作流提交的prompt（重启后重新关联时可能遇到）
+        for node_id in LEGACY_OUTPUT_NODES:
+            node_images = (outputs.get(node_id) or {}).get("images")
+            if node_images:
+                images = node_images
+                output_node = node_id
+                break
+    
+    if not images:
+        # 调试日志：显示所有可用的输出节点
+        available_nodes = list(outputs.keys())
+        logger.error(f"❌ 任务 {task_id} - 未找到图像输出节点，可用节点: {available_nodes}")
+        raise Exception(f"未找到生成的图像，可用节点: {available_nodes}")
+    
+    # 调试日志：记录图像数量和输出节点
+    logger.info(f"🖼️ 任务 {task_id} - 从节点{output_node}获取到 {len(images)} 张图片")
+    return images
+
+async def save_task_images(task_id: str, comfy: ComfyUIManager, images: List[Dict]) -> List[str]:
+    """从ComfyUI并发下载结果图片直接写入输出目录，返回图片URL列表（顺序与images一致）"""
+    
+    async def save(i: int, image_info: Dict) -> str:
+        # 保存图像（添加序号区分）
+        base_name = image_info['filename'].rsplit('.', 1)[0]
+        extension = image_info['filename'].rsplit('.', 1)[1] if '.' in image_info['filename'] else 'png'
+        filename = f"{task_id}_{base_name}_{i+1:02d}.{extension}"
+        
+        await comfy.download_image_to_file(
+            image_info["filename"], 
+            image_info.get("subfolder", ""),
+            image_info.get("type", "output"),
+            OUTPUT_DIR / filename
+        )
+        return f"/images/{filename}"
+    
+    # 处理所有生成的图像（全局并发数由下载信号量限制）
+    result_urls = list(await asyncio.gather(*(save(i, image_info) for i, image_info in enumerate(images))))
+    
+    # 调试日志：记录保存的图片URLs
+    logger.info(f"💾 任务 {task_id} - 保存了 {len(result_urls)} 个图片URL: {result_urls}")
+    return result_urls
+
+def complete_task(task_id: str, task_manager: TaskManager, result_urls: List[str]):
+    # 更新任务状态（包含所有图片URL）
+    task_manager.update_task(
+        task_id, 
+        status="completed", 
+        progress=100, 
+        message=f"生成完成 ({len(result_urls)}张图片)",
+        result_url=result_urls[0] if result_urls else None,
+        result_urls=result_urls  # 添加多图片支持
+    )
+    
+    # 调试日志：确认任务状态更新
+    logger.info(f"✅ 任务 {task_id} - 状态更新完成，多图URLs已保存")
+
+async def collect_task_results(task_id: str, request: TaskRequest, task_manager: TaskManager,
+                               comfy: ComfyUIManager, prompt_id: str, check_history_first: bool = False,
+                               workflow: Optional[Dict] = None, output_nodes: Optional[List[str]] = None):
+    """等待已提交的prompt完成，下载结果并更新任务状态"""
+    try:
+        images = await wait_for_prompt_images(task_id, task_manager, comfy, prompt_id,
+                                              check_history_first=check_history_first,
+                                              workflow=workflow, output_nodes=output_nodes)
+    except asyncio.TimeoutError:
+        task_manager.update_task(task_id, status="failed", error="任务超时")
+        return
+    
+    if isinstance(request, GenerationRequest) and len(images) != request.batch_size:
+        logger.info(f"🖼️ 任务 {task_id} - 请求的batch_size: {request.batch_size}, 实际生成: {len(images)} 张")
+        logger.warning(f"⚠️ 任务 {task_id} - 生成数量不匹配！请求: {request.batch_size} 张, 实际: {len(images)} 张")
+    
+    task_manager.update_task(task_id, progress=90, message="下载生成结果...")
+    result_urls = await save_task_images(task_id, comfy, images)
+    complete_task(task_id, task_manager, result_urls)
+
+async def process_single_task(task_id: str, request: TaskRequest, task_manager: TaskManager):
+    """处理单个生成任务（路由到负载最低的ComfyUI节点）"""
+    backend = await backend_pool.acquire_backend()
+    logger.info(f"🧭 任务 {task_id} - 路由到ComfyUI节点: {backend.url} (队列深度 {backend.queue_depth})")
+    try:
+        if isinstance(request, PipelineRequest):
+            await run_pipeline_task_on_backend(task_id, request, task_manager, backend)
+        elif isinstance(request, WorkflowRequest):
+            await run_workflow_task_on_backend(task_id, request, task_manager, backend)
+        else:
+            await run_task_on_backend(task_id, request, task_manager, backend)
+    finally:
+        backend_pool.release_backend(backend)
 
-async def process_single_task(task_id: str, request: GenerationRequest, task_manager: TaskManager):
-    """处理单个生成任务"""
+async def submit_and_collect(task_id: str, request: TaskRequest, task_manager: TaskManager,
+                             backend: ComfyUIBackend, workflow: Dict, output_nodes: List[str]):
+    """校验并提交工作流到指定节点，等待完成并下载结果"""
+    # 提交前用该节点的节点定义校验，确定会失败的工作流不占用ComfyUI队列和重试
+    await backend_pool.validate_workflow(workflow, backend)
+    
+    ws_workflow = websocket_delivery_workflow(workflow, output_nodes) if await backend_pool.websocket_delivery_available(backend) else None
+    if ws_workflow is not None:
+        try:
+            await submit_and_receive(task_id, task_manager, backend, ws_workflow, output_nodes)
+            return
+        except WebSocketDeliveryError as e:
+            backend_pool.delivery_stats["fallbacks"] += 1
+            logger.warning(f"⚠️ 任务 {task_id} - {e}，改用/view下载重新提交")
+    
+    prompt_id = None
+    try:
+        async with ComfyUIManager(backend) as comfy:
+            task_manager.update_task(task_id, progress=25, message="提交任务到ComfyUI...")
+            
+            # 提交任务
+            prompt_id = await comfy.submit_prompt(workflow)
+            backend_pool.bind_prompt(prompt_id, backend)
+            
+            # 持久化prompt_id和所在节点，服务重启后可重新关联而不是重新生成
+            task_manager.update_task(task_id, progress=35, message="等待ComfyUI处理...",
+                                     prompt_id=prompt_id, backend=backend.url)
+            
+            await collect_task_results(task_id, request, task_manager, comfy, prompt_id,
+                                       workflow=workflow, output_nodes=output_nodes)
+    finally:
+        if prompt_id:
+            backend_pool.unbind_prompt(prompt_id)
+
+async def submit_and_receive(task_id: str, task_manager: TaskManager, backend: ComfyUIBackend,
+                             workflow: Dict, image_nodes: List[str]):
+    """提交输出节点已改为SaveImageWebsocket的工作流，结果图片经共享WebSocket推送后直接写入输出目录
+
+    推送的图片ComfyUI不落盘，无法在服务重启后找回，因此不持久化prompt_id（重启后任务重新排队）。
+    推送期间连接断开或没有收到图片时抛出 WebSocketDeliveryError。
+    """
+    receiver = WebSocketImageReceiver(task_id, image_nodes)
+    connects = backend.listener.stats["connects"]
+    prompt_id = None
+    try:
+        async with ComfyUIManager(backend) as comfy:
+            task_manager.update_task(task_id, progress=25, message="提交任务到ComfyUI...")
+            prompt_id = await comfy.submit_prompt(workflow)
+            backend_pool.bind_prompt(prompt_id, backend)
+            task_manager.update_task(task_id, progress=35, message="等待ComfyUI处理...", backend=backend.url)
+            try:
+                await wait_for_prompt_history(task_id, task_manager, comfy, prompt_id, workflow=workflow, receiver=receiver)
+            except asyncio.TimeoutError:
+                await receiver.discard()
+                task_manager.update_task(task_id, status="failed", error="任务超时")
+                return
+    except BaseException:
+        await receiver.discard()
+        raise
+    finally:
+        if prompt_id:
+            backend_pool.unbind_prompt(prompt_id)
+    
+    if backend.listener.stats["connects"] != connects or not backend.listener.connected or not receiver.filenames:
+        await receiver.discard()
+        raise WebSocketDeliveryError("WebSocket推送结果图片不完整" if receiver.filenames else "没有收到WebSocket推送的结果图片")
+    
+    task_manager.update_task(task_id, progress=90, message="保存生成结果...")
+    result_urls = await receiver.save()
+    backend_pool.delivery_stats["websocket_tasks"] += 1
+    logger.info(f"💾 任务 {task_id} - 经WebSocket接收并保存了 {len(result_urls)} 张图片: {result_urls}")
+    complete_task(task_id, task_manager, result_urls)
+
+async def run_workflow_task_on_backend(task_id: str, request: WorkflowRequest, task_manager: TaskManager,
+                                       backend: ComfyUIBackend):
+    """在指定ComfyUI节点上执行任意工作流任务（上传输入图片、渲染、提交、等待、下载）"""
     try:
         task_manager.update_task(task_id, status="running", progress=5, message="准备输入数据...")
         
-        # 调试日志：记录请求参数
-        logger.info(f"🎯 任务 {task_id} - 请求参数: batch_size={request.batch_size}, 尺寸={request.width}x{request.height}, input_image={request.input_image}")
+        comfy_images = {}
+        if request.images:
+            task_manager.update_task(task_id, progress=10, message=f"上传{len(request.images)}张图片到ComfyUI...")
+            budgets = get_input_pixel_budgets(create_custom_workflow(request)[0])
+            max_pixels = [budgets.get(WorkflowTemplate.parse_target(target)[0], 0) for target in request.images]
+            async with ComfyUIManager(backend) as comfy:
+                uploaded = await comfy.upload_local_images(list(request.images.values()), max_pixels)
+            comfy_images = {target: uploaded[filename] for target, filename in request.images.items()}
+        
+        task_manager.update_task(task_id, progress=15, message="创建工作流...")
+        workflow, output_nodes = create_custom_workflow(request, comfy_images)
+        logger.info(f"🔧 任务 {task_id} - 工作流: {request.template_id or '自定义'} ({len(workflow)} 个节点), "
+                    f"输出节点: {', '.join(output_nodes)}")
         
-        # 如果有输入图片，先上传到ComfyUI服务器
-        comfyui_image_name = None
-        if request.input_image:
-            task_manager.update_task(task_id, progress=10, message="上传图片到ComfyUI...")
+        await submit_and_collect(task_id, request, task_manager, backend, workflow, output_nodes)
+    except Exception as e:
+        logger.error(f"任务 {task_id} 处理失败: {e}")
+        task_manager.update_task(task_id, status="failed", error=str(e))
+
+async def run_pipeline_task_on_backend(task_id: str, request: PipelineRequest, task_manager: TaskManager,
+                                       backend: ComfyUIBackend):
+    """在同一ComfyUI节点上依次执行流水线各阶段
+
+    上一阶段的输出图片以 "文件名 [output]" 的形式直接交给下一阶段的LoadImage，中间结果不经过API服务器；
+    上一阶段输出多张图片时，下一阶段对每张图片各提交一个prompt（并发排队），只下载最后一个阶段的结果。
+    中间阶段的prompt_id不持久化，服务重启后流水线任务整体重新排队。
+    """
+    stage_count = len(request.stages)
+    try:
+        task_manager.update_task(task_id, status="running", progress=5, message="准备输入数据...")
+        
+        async with ComfyUIManager(backend) as comfy:
+            stage_inputs = [{}]
+            if request.images:
+                task_manager.update_task(task_id, progress=10, message=f"上传{len(request.images)}张图片到ComfyUI...")
+                first_stage = stage_workflow_request(request.stages[0], request.images)
+                budgets = get_input_pixel_budgets(create_custom_workflow(first_stage)[0])
+                max_pixels = [budgets.get(WorkflowTemplate.parse_target(target)[0], 0) for target in request.images]
+                uploaded = await comfy.upload_local_images(list(request.images.values()), max_pixels)
+                stage_inputs = [{target: uploaded[filename] for target, filename in request.images.items()}]
+            
+            async def run_prompt(workflow: Dict, output_nodes: List[str], progress_range: Tuple[float, float],
+                                 report: bool) -> List[Dict]:
+                prompt_id = await comfy.submit_prompt(workflow)
+                backend_pool.bind_prompt(prompt_id, backend)
+                try:
+                    return await wait_for_prompt_images(task_id, task_manager, comfy, prompt_id, workflow=workflow,
+                                                        output_nodes=output_nodes, progress_range=progress_range,
+                                                        report=report)
+                finally:
+                    backend_pool.unbind_prompt(prompt_id)
             
-            # 读取本地上传的图片文件
-            local_image_path = Path("./uploaded_images") / request.input_image
-            if local_image_path.exists():
-                with open(local_image_path, "rb") as f:
-                    image_data = f.read()
+            images: List[Dict] = []
+            for index, stage in enumerate(request.stages):
+                label = f"阶段{index + 1}/{stage_count}"
+                progress_range = (
+                    round(PromptProgressTracker.START + (PromptProgressTracker.END - PromptProgressTracker.START) * index / stage_count, 1),
+                    round(PromptProgressTracker.START + (PromptProgressTracker.END - PromptProgressTracker.START) * (index + 1) / stage_count, 1)
+                )
+                runs = []
+                for stage_images in stage_inputs:
+                    workflow, output_nodes = create_custom_workflow(stage_workflow_request(stage), stage_images)
+                    await backend_pool.validate_workflow(workflow, backend)
+                    runs.append((workflow, output_nodes))
                 
-                async with ComfyUIManager() as comfy:
-                    try:
-                        comfyui_image_name = await comfy.upload_image_to_comfyui(image_data, request.input_image)
-                        logger.info(f"✅ 任务 {task_id} - 图片已上传到ComfyUI: {comfyui_image_name}")
-                        
-                        # 更新request中的图片名称为ComfyUI中的名称
-                        request.input_image = comfyui_image_name
-                    except Exception as e:
-                        logger.error(f"❌ 任务 {task_id} - ComfyUI图片上传失败: {e}")
-                        task_manager.update_task(task_id, status="failed", error=f"图片上传失败: {str(e)}")
-                        return
-            else:
-                logger.error(f"❌ 任务 {task_id} - 本地图片文件不存在: {local_image_path}")
-                task_manager.update_task(task_id, status="failed", error="本地图片文件不存在")
-                return
+                task_manager.update_task(task_id, progress=max(25, progress_range[0] - 5),
+                                         message=f"{label}: 提交{len(runs)}个工作流到ComfyUI...")
+                logger.info(f"🔗 任务 {task_id} - {label} ({stage.template_id or '自定义'}) 提交 {len(runs)} 个prompt @ {backend.url}")
+                results = await asyncio.gather(*(
+                    run_prompt(workflow, output_nodes, progress_range, report=(i == 0))
+                    for i, (workflow, output_nodes) in enumerate(runs)
+                ))
+                images = [image for stage_images in results for image in stage_images]
+                
+                if index + 1 < stage_count:
+                    target = get_stage_input(request.stages[index + 1])
+                    stage_inputs = [{target: comfyui_output_reference(image)} for image in images]
+            
+            task_manager.update_task(task_id, progress=90, message="下载生成结果...")
+            result_urls = await save_task_images(task_id, comfy, images)
+        complete_task(task_id, task_manager, result_urls)
+    except asyncio.TimeoutError:
+        task_manager.update_task(task_id, status="failed", error="任务超时")
+    except Exception as e:
+        logger.error(f"任务 {task_id} 处理失败: {e}")
+        task_manager.update_task(task_id, status="failed", error=str(e))
+
+async def run_task_on_backend(task_id: str, request: GenerationRequest, task_manager: TaskManager,
+                              backend: ComfyUIBackend):
+    """在指定ComfyUI节点上执行单个生成任务（上传、提交、等待、下载都在同一节点）"""
+    try:
+        task_manager.update_task(task_id, status="running", progress=5, message="准备输入数据...")
+        
+        # 调试日志：记录请求参数
+        input_images = get_request_images(request)
+        logger.info(f"🎯 任务 {task_id} - 请求参数: batch_size={request.batch_size}, 尺寸={request.width}x{request.height}, input_images={input_images}")
+        
+        # 如果有输入图片，先并发上传到ComfyUI服务器
+        comfyui_images = None
+        if input_images:
+            task_manager.update_task(task_id, progress=10, message=f"上传{len(input_images)}张图片到ComfyUI...")
+            # 按各图片槽位后续缩放节点的像素预算缩小后再上传
+            template = get_request_template(request)
+            budgets = get_input_pixel_budgets(create_workflow(request))
+            max_pixels = [budgets.get(slot[0], 0) for slot in template.image_slots[:len(input_images)]]
+            async with ComfyUIManager(backend) as comfy:
+                try:
+                    uploaded = await comfy.upload_local_images(input_images, max_pixels)
+                except Exception as e:
+                    logger.error(f"❌ 任务 {task_id} - ComfyUI图片上传失败: {e}")
+                    task_manager.update_task(task_id, status="failed", error=f"图片上传失败: {str(e)}")
+                    return
+            comfyui_images = [uploaded[filename] for filename in input_images]
+            logger.info(f"✅ 任务 {task_id} - 图片已上传到ComfyUI: {comfyui_images}")
         
         task_manager.update_task(task_id, progress=15, message="创建工作流...")
         
         # 创建工作流
-        workflow = create_workflow(request)
+        template = get_request_template(request)
+        workflow = create_workflow(request, comfyui_images)
         
         # 调试日志：记录工作流关键节点
-        workflow_type = "Qwen文生图" if not request.input_image else "Qwen图生图"
-        batch_node = '58' if not request.input_image else '115:112'
-        output_node = '60'  # 新工作流统一使用节点60作为SaveImage输出
-        batch_size_in_workflow = workflow.get(batch_node, {}).get('inputs', {}).get('batch_size', 'N/A')
+        batch_node, batch_input = (template.bindings.get("batch_size") or [("N/A", "batch_size")])[0]
+        batch_size_in_workflow = workflow.get(batch_node, {}).get('inputs', {}).get(batch_input, 'N/A')
         
-        logger.info(f"🔧 任务 {task_id} - 工作流类型: {workflow_type}")
+        logger.info(f"🔧 任务 {task_id} - 工作流模板: {template.name} ({template.id})")
         logger.info(f"🔧 任务 {task_id} - 请求参数 batch_size: {request.batch_size}")
         logger.info(f"🔧 任务 {task_id} - 批量节点({batch_node})的batch_size: {batch_size_in_workflow}")
-        logger.info(f"🔧 任务 {task_id} - 输出节点: {output_node} (SaveImage)")
+        logger.info(f"🔧 任务 {task_id} - 输出节点: {', '.join(template.output_nodes)}")
         
         # 验证 batch_size 是否正确设置
         if batch_size_in_workflow != request.batch_size:
             logger.warning(f"⚠️ 任务 {task_id} - batch_size 不匹配！请求: {request.batch_size}, 工作流: {batch_size_in_workflow}")
         
-        async with ComfyUIManager() as comfy:
-            task_manager.update_task(task_id, progress=25, message="提交任务到ComfyUI...")
-            
-            # 提交任务
-            prompt_id = await comfy.submit_prompt(workflow)
-            
-            task_manager.update_task(task_id, progress=35, message="等待ComfyUI处理...")
-            
-            # 等待任务完成
-            max_attempts = 150  # 5分钟超时
-            consecutive_failures = 0
-            max_consecutive_failures = 10  # 连续失败10次后报错
-            
-            for attempt in range(max_attempts):
-                await asyncio.sleep(2)
-                
-                progress = 35 + (attempt / max_attempts) * 55  # 35% 到 90%
-                task_manager.update_task(task_id, progress=progress, message="ComfyUI生成中...")
-                
-                try:
-                    history = await comfy.get_history(prompt_id)
-                    consecutive_failures = 0  # 重置连续失败计数
-                except Exception as e:
-                    consecutive_failures += 1
-                    logger.warning(f"⚠️ 任务 {task_id} - 获取历史失败 ({consecutive_failures}/{max_consecutive_failures}): {e}")
-                    
-                    if consecutive_failures >= max_consecutive_failures:
-                        logger.error(f"❌ 任务 {task_id} - 连续失败次数过多，可能连接已断开")
-                        task_manager.update_task(task_id, status="failed", error=f"连接ComfyUI服务器失败: {str(e)}")
-                        return
-                    
-                    # 继续尝试，但使用空历史
-                    history = {}
-                
-                if prompt_id in history:
-                    task_manager.update_task(task_id, progress=90, message="下载生成结果...")
-                    
-                    # 调试日志：记录ComfyUI返回的完整历史数据
-                    logger.info(f"📋 任务 {task_id} - ComfyUI历史数据: {json.dumps(history[prompt_id], indent=2, ensure_ascii=False)}")
-                    
-                    # 获取生成的图像（支持多张）- 自适应不同工作流
-                    outputs = history[prompt_id]["outputs"]
-                    
-                    # 尝试不同的输出节点
-                    images = None
-                    output_node = None
-                    
-                    if "60" in outputs and outputs["60"]["images"]:
-                        # Qwen工作流SaveImage输出节点（新配置）
-                        images = outputs["60"]["images"]
-                        output_node = "60"
-                    elif "8" in outputs and outputs["8"]["images"]:
-                        # 兼容旧的Qwen文生图工作流输出节点
-                        images = outputs["8"]["images"]
-                        output_node = "8"
-                    elif "115:116" in outputs and outputs["115:116"]["images"]:
-                        # 兼容Qwen图生图工作流输出节点
-                        images = outputs["115:116"]["images"]
-                        output_node = "115:116"
-                    
-                    if images:
-                        # 调试日志：记录图像数量和输出节点
-                        logger.info(f"🖼️ 任务 {task_id} - 从节点{output_node}获取到 {len(images)} 张图片")
-                        logger.info(f"🖼️ 任务 {task_id} - 请求的batch_size: {request.batch_size}, 实际生成: {len(images)} 张")
-                        if len(images) != request.batch_size:
-                            logger.warning(f"⚠️ 任务 {task_id} - 生成数量不匹配！请求: {request.batch_size} 张, 实际: {len(images)} 张")
-                        
-                        result_urls = []
-                        
-                        # 处理所有生成的图像
-                        for i, image_info in enumerate(images):
-                            # 下载图像
-                            image_data = await comfy.download_image(
-                                image_info["filename"], 
-                                image_info.get("subfolder", ""),
-                                image_info.get("type", "output")
-                            )
-                            
-                            # 保存图像（添加序号区分）
-                            base_name = image_info['filename'].rsplit('.', 1)[0]
-                            extension = image_info['filename'].rsplit('.', 1)[1] if '.' in image_info['filename'] else 'png'
-                            filename = f"{task_id}_{base_name}_{i+1:02d}.{extension}"
-                            file_path = OUTPUT_DIR / filename
-                            
-                            with open(file_path, "wb") as f:
-                                f.write(image_data)
-                            
-                            result_urls.append(f"/images/{filename}")
-                        
-                        # 调试日志：记录保存的图片URLs
-                        logger.info(f"💾 任务 {task_id} - 保存了 {len(result_urls)} 个图片URL: {result_urls}")
-                        
-                        # 更新任务状态（包含所有图片URL）
-                        task_manager.update_task(
-                            task_id, 
-                            status="completed", 
-                            progress=100, 
-                            message=f"生成完成 ({len(result_urls)}张图片)",
-                            result_url=result_urls[0] if result_urls else None,
-                            result_urls=result_urls  # 添加多图片支持
-                        )
-                        
-                        # 调试日志：确认任务状态更新
-                        logger.info(f"✅ 任务 {task_id} - 状态更新完成，多图URLs已保存")
-                        return
-                    else:
-                        # 调试日志：显示所有可用的输出节点
-                        available_nodes = list(outputs.keys())
-                        logger.error(f"❌ 任务 {task_id} - 未找到图像输出节点，可用节点: {available_nodes}")
-                        raise Exception(f"未找到生成的图像，可用节点: {available_nodes}")
-            
-            # 超时
-            task_manager.update_task(task_id, status="failed", error="任务超时")
+        await submit_and_collect(task_id, request, task_manager, backend, workflow, template.output_nodes)
             
     except Exception as e:
         logger.error(f"任务 {task_id} 处理失败: {e}")
         task_manager.update_task(task_id, status="failed", error=str(e))
 
+class TaskScheduler:
+    """进程内优先级任务调度器
+
+    任务按 (优先级降序, 提交时间, 提交序号) 排队，由固定数量的worker取出执行，
+    worker总数 = 节点数 × 每节点并发数，避免一次性把所有任务压到ComfyUI队列。
+    """
+
+    def __init__(self, task_manager: TaskManager, backend_pool: ComfyUIBackendPool,
+                 workers_per_backend: int = WORKERS_PER_BACKEND):
+        self.task_manager = task_manager
+        self.backend_pool = backend_pool
+        self.workers_per_backend = workers_per_backend
+        self._queue: Optional[asyncio.PriorityQueue] = None  # 在事件循环内惰性创建
+        self._seq = itertools.count()
+        self._workers: List[asyncio.Task] = []
+        self._reattached: set = set()  # 重新关联中的任务（保持引用避免被回收）
+        self.running = 0
+        self.stats = {"submitted": 0, "completed": 0, "recovered_pending": 0, "reattached": 0}
+
+    @property
+    def queue(self) -> asyncio.PriorityQueue:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        return self._queue
+
+    def submit(self, task_id: str, request: TaskRequest, priority: int = 0,
+               submitted_at: Optional[float] = None):
+        """任务入队（立即返回）"""
+        submitted_at = submitted_at if submitted_at is not None else time.time()
+        self.queue.put_nowait((-priority, submitted_at, next(self._seq), task_id, request))
+        self.stats["submitted"] += 1
+
+    async def start(self):
+        """启动worker"""
+        if self._workers:
+            return
+        worker_count = max(1, self.workers_per_backend * len(self.backend_pool.backends))
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(worker_count)]
+        logger.info(f"🧵 任务调度器已启动: {worker_count} 个worker ({self.workers_per_backend}/节点)")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self, index: int):
+        while True:
+            _, _, _, task_id, request = await self.queue.get()
+            self.running += 1
+            try:
+                await process_single_task(task_id, request, self.task_manager)
+            except Exception as e:
+                logger.error(f"❌ worker {index} 执行任务 {task_id} 异常: {e}")
+            finally:
+                self.running -= 1
+                self.stats["completed"] += 1
+                self.queue.task_done()
+
+    async def recover(self):
+        """服务启动时恢复重启前未完成的任务
+
+        - pending任务按原优先级和创建时间重新入队
+        - running且已有prompt_id的任务重新关联到原ComfyUI节点，不重复生成
+        """
+        unfinished = await self.task_manager.get_unfinished_tasks()
+        if not unfinished:
+            return
+        logger.info(f"♻️ 发现 {len(unfinished)} 个未完成任务，开始恢复")
+        for item in unfinished:
+            task = item["task"]
+            try:
+                request = parse_task_request(task.request_data)
+            except Exception as e:
+                logger.error(f"❌ 任务 {task.task_id} 请求参数无法恢复: {e}")
+                self.task_manager.update_task(task.task_id, status="failed", error=f"服务重启后无法恢复任务: {e}")
+                continue
+            try:
+                submitted_at = datetime.fromisoformat(task.created_at).timestamp()
+            except ValueError:
+                submitted_at = time.time()
+
+            backend = self.backend_pool.get_backend_by_url(task.backend)
+            if task.status == "running" and task.prompt_id and backend:
+                reattach = asyncio.create_task(
+                    self._reattach(task.task_id, request, backend, task.prompt_id, item["priority"], submitted_at)
+                )
+                self._reattached.add(reattach)
+                reattach.add_done_callback(self._reattached.discard)
+            else:
+                self.task_manager.update_task(task.task_id, status="pending", progress=0, message="服务重启后重新排队")
+                self.submit(task.task_id, request, item["priority"], submitted_at)
+                self.stats["recovered_pending"] += 1
+
+    async def _reattach(self, task_id: str, request: TaskRequest, backend: ComfyUIBackend,
+                        prompt_id: str, priority: int, submitted_at: float):
+        """重新关联已提交到ComfyUI的任务；节点上找不到该prompt时重新入队"""
+        self.backend_pool.reserve_backend(backend)
+        try:
+            async with ComfyUIManager(backend) as comfy:
+                try:
+                    state = await comfy.get_prompt_state(prompt_id)
+                except Exception as e:
+                    logger.warning(f"⚠️ 任务 {task_id} - 无法查询prompt {prompt_id} 状态: {e}")
+                    state = "unknown"
+
+                if state == "unknown":
+                    # 节点已重启或队列被清空，只能重新生成
+                    logger.info(f"♻️ 任务 {task_id} - prompt {prompt_id} 已不在节点 {backend.url} 上，重新入队")
+                    self.task_manager.update_task(task_id, status="pending", progress=0, message="服务重启后重新排队")
+                    self.submit(task_id, request, priority, submitted_at)
+                    self.stats["recovered_pending"] += 1
+                    return
+
+                logger.info(f"♻️ 任务 {task_id} - 重新关联prompt {prompt_id} ({state}) @ {backend.url}")
+                self.stats["reattached"] += 1
+                self.backend_pool.bind_prompt(prompt_id, backend)
+                self.task_manager.update_task(task_id, message="服务重启后已重新关联ComfyUI任务")
+                try:
+                    workflow, output_nodes = build_task_workflow(request)
+                    await collect_task_results(task_id, request, self.task_manager, comfy, prompt_id,
+                                               check_history_first=True, workflow=workflow,
+                                               output_nodes=output_nodes)
+                except Exception as e:
+                    logger.error(f"任务 {task_id} 处理失败: {e}")
+                    self.task_manager.update_task(task_id, status="failed", error=str(e))
+                finally:
+                    self.backend_pool.unbind_prompt(prompt_id)
+        finally:
+            self.backend_pool.release_backend(backend)
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["queued"] = self.queue.qsize()
+        stats["running"] = self.running
+        stats["reattaching"] = len(self._reattached)
+        stats["workers"] = len(self._workers)
+        return stats
+
 # 全局任务管理器
 task_manager = TaskManager()
 
+# 全局任务调度器
+scheduler = TaskScheduler(task_manager, backend_pool)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动/关闭共享资源"""
+    await comfy_pool.start()
+    await task_manager.start()
+    await backend_pool.start()
+    await scheduler.recover()
+    await scheduler.start()
+    yield
+    await scheduler.stop()
+    await backend_pool.stop()
+    await comfy_pool.close()
+    await task_manager.stop()
+    # 等待写线程落盘剩余操作后关闭数据库连接
+    await asyncio.get_running_loop().run_in_executor(None, task_manager.db.close)
+
 # 创建FastAPI应用
 app = FastAPI(
     title="ComfyUI批量生图API",
     description="企业级ComfyUI API封装，支持批量远程生图",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置CORS
@@ -990,64 +3412,386 @@ async def root():
         "endpoints": {
             "generate": "/generate - 单个图像生成",
             "batch": "/batch - 批量图像生成", 
+            "workflow": "/workflow - 提交任意工作流（API格式工作流或模板 + 参数覆盖）",
+            "pipeline": "/pipeline - 多阶段流水线（如 文生图 → 角色抠图，中间图片不经过API服务器）",
             "status": "/status/{task_id} - 查询任务状态",
-            "tasks": "/tasks - 获取所有任务",
-            "ws": "/ws - WebSocket实时更新"
+            "tasks": "/tasks - 分页获取任务（支持status/batch_name/时间过滤、cursor翻页、fields字段投影）",
+            "events": "/events - 任务事件流（SSE，支持Last-Event-ID断点续传）",
+            "workflow_templates": "/workflow_templates - 已加载的工作流模板",
+            "upload_images": "/upload_images - 批量上传图片（按内容去重）",
+            "ws": "/ws - WebSocket实时更新",
+            "stats": "/stats - 运行时统计（连接池复用等）"
         }
     }
 
-@app.post("/upload_image")
-async def upload_image(file: UploadFile = File(...)):
-    """上传图片文件"""
-    try:
-        # 检查文件类型
-        if not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="文件必须是图片格式")
-        
-        # 创建上传目录
-        upload_dir = Path("./uploaded_images")
-        upload_dir.mkdir(exist_ok=True)
-        
-        # 保存文件
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'png'
-        saved_filename = f"{int(time.time() * 1000)}.{file_extension}"
-        file_path = upload_dir / saved_filename
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        return {"filename": saved_filename, "path": str(file_path)}
+class UploadRejected(Exception):
+    """上传被拒绝（格式、大小、数量不符合要求）"""
+
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+        super().__init__(detail)
+
+class ImageUploadSink:
+    """multipart中的一个图片文件：分块写入临时文件并同时计算sha256，结束后按内容哈希命名
+
+    文件写入和哈希计算在线程池中执行；内容相同的图片只保存一份。
+    """
+    
+    SNIFF_BYTES = 16
+    
+    def __init__(self, original_filename: str, content_type: str):
+        self.original_filename = original_filename
+        self.content_type = content_type
+        self.size = 0
+        self.head = b""
+        self.extension = ""
+        self.pending: List[bytes] = []
+        self.hasher = hashlib.sha256()
+        self.temp_path = UPLOAD_DIR / f".upload-{uuid.uuid4().hex}.part"
+        self.file = None
+    
+    def feed(self, data: bytes):
+        """解析器回调中调用（同步）：检查大小和文件头，数据暂存到pending等待flush"""
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_BYTES:
+            raise UploadRejected(413, f"图片 {self.original_filename} 超过大小上限 {UPLOAD_MAX_BYTES // (1024 * 1024)}MB")
+        if not self.extension:
+            self.head += data[:self.SNIFF_BYTES]
+            if len(self.head) >= self.SNIFF_BYTES:
+                self._check_type()
+        self.pending.append(data)
+    
+    def _check_type(self):
+        extension, _ = detect_image_type(self.head)
+        if extension not in UPLOAD_ALLOWED_EXTENSIONS:
+            raise UploadRejected(400, f"文件 {self.original_filename} 不是支持的图片格式（{', '.join(sorted(UPLOAD_ALLOWED_EXTENSIONS))}）")
+        self.extension = extension
+    
+    def _write(self, chunks: List[bytes]):
+        if self.file is None:
+            self.file = open(self.temp_path, "wb")
+        for chunk in chunks:
+            self.file.write(chunk)
+            self.hasher.update(chunk)
+    
+    async def flush(self):
+        if self.pending:
+            chunks, self.pending = self.pending, []
+            await asyncio.get_running_loop().run_in_executor(None, self._write, chunks)
+    
+    def _commit(self) -> Dict:
+        if self.file is None:
+            self.file = open(self.temp_path, "wb")
+        self.file.close()
+        digest = self.hasher.hexdigest()
+        filename = f"{digest[:32]}{self.extension}"
+        path = UPLOAD_DIR / filename
+        duplicate = path.exists()
+        if duplicate:
+            self.temp_path.unlink()
+        else:
+            os.replace(self.temp_path, path)
+        return {
+            "filename": filename,
+            "path": str(path),
+            "sha256": digest,
+            "size": self.size,
+            "original_filename": self.original_filename,
+            "duplicate": duplicate
+        }
+    
+    async def finish(self) -> Dict:
+        if not self.extension:
+            self._check_type()
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(None, self._commit)
+    
+    def _discard(self):
+        if self.file is not None:
+            self.file.close()
+        self.temp_path.unlink(missing_ok=True)
+    
+    async def abort(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._discard)
+
+class ImageUploadReceiver:
+    """流式解析multipart请求体，把其中的图片文件写入 uploaded_images/（不经过内存或临时spool整体缓存）
+
+    Content-Length超过上限时在读取请求体之前拒绝；格式和大小在读到对应数据时立即检查，不合格则中止并清理临时文件。
+    """
+    
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self.header_field = b""
+        self.header_value = b""
+        self.headers: Dict[bytes, bytes] = {}
+        self.current: Optional[ImageUploadSink] = None
+        self.sinks: List[ImageUploadSink] = []
+        self.finished: List[ImageUploadSink] = []
+        self.results: List[Dict] = []
+        self.committed: List[ImageUploadSink] = []  # 已落盘的文件（中止时保留，内容寻址不会冲突）
+    
+    def on_part_begin(self):
+        self.headers = {}
+        self.current = None
+    
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_field += data[start:end]
+    
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+    
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b""
+        self.header_value = b""
+    
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        if b"filename" not in options:
+            return  # 普通表单字段，忽略
+        if len(self.sinks) >= self.max_files:
+            raise UploadRejected(400, f"单次最多上传 {self.max_files} 个文件")
+        original_filename = options[b"filename"].decode("utf-8", errors="replace")
+        content_type = self.headers.get(b"content-type", b"").decode("latin-1")
+        if content_type and not content_type.startswith("image/"):
+            raise UploadRejected(400, f"文件 {original_filename} 必须是图片格式")
+        self.current = ImageUploadSink(original_filename, content_type)
+        self.sinks.append(self.current)
+    
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self.current is not None:
+            self.current.feed(data[start:end])
+    
+    def on_part_end(self):
+        if self.current is not None:
+            self.finished.append(self.current)
+            self.current = None
+    
+    async def receive(self, request: Request) -> List[Dict]:
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="请使用 multipart/form-data 上传图片")
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_BYTES * self.max_files + 1024 * 1024:
+            raise HTTPException(status_code=413, detail=f"请求体过大（单张图片上限 {UPLOAD_MAX_BYTES // (1024 * 1024)}MB）")
         
-    except Exception as e:
-        logger.error(f"图片上传失败: {e}")
-        raise HTTPException(status_code=500, detail=f"图片上传失败: {str(e)}")
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                # 解析器回调是同步的，文件写入在每块数据解析后统一在线程池中执行
+                if self.current is not None:
+                    await self.current.flush()
+                while self.finished:
+                    sink = self.finished.pop(0)
+                    self.results.append(await sink.finish())
+                    self.committed.append(sink)
+            parser.finalize()
+        except UploadRejected as e:
+            await self._abort()
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except BaseException:
+            await self._abort()
+            raise
+        return self.results
+    
+    async def _abort(self):
+        for sink in self.sinks:
+            if sink not in self.committed:
+                await sink.abort()
+
+@app.post("/upload_image")
+async def upload_image(request: Request):
+    """上传图片文件（multipart字段 file），按内容哈希命名，相同图片只保存一份"""
+    files = await ImageUploadReceiver(max_files=1).receive(request)
+    if not files:
+        raise HTTPException(status_code=400, detail="缺少图片文件")
+    logger.info(f"📤 图片已上传: {files[0]['original_filename']} -> {files[0]['filename']} ({files[0]['size']} 字节)")
+    return files[0]
+
+@app.post("/upload_images")
+async def upload_images(request: Request):
+    """批量上传图片文件（multipart中的多个文件字段），返回顺序与上传顺序一致"""
+    files = await ImageUploadReceiver(max_files=UPLOAD_MAX_FILES).receive(request)
+    if not files:
+        raise HTTPException(status_code=400, detail="缺少图片文件")
+    logger.info(f"📤 批量上传了 {len(files)} 张图片（{sum(1 for f in files if f['duplicate'])} 张已存在）")
+    return {"files": files, "count": len(files)}
+
+VALIDATION_FREE_TEXT_FIELDS = {"prompt", "negative_prompt", "batch_name"}  # 不影响节点定义校验结果的请求字段
+
+async def validate_generation_requests(requests: List[GenerationRequest]):
+    """API入口校验：输入图片存在、工作流符合ComfyUI节点定义；不通过返回422
+
+    提示词等自由文本不影响校验结果，其余参数（含seed和输入图片）完全相同的请求只校验一次。
+    """
+    errors = []
+    checked: Dict[str, List[str]] = {}
+    for index, request in enumerate(requests):
+        prefix = f"requests[{index}]: " if len(requests) > 1 else ""
+        images = get_request_images(request)
+        missing = [name for name in images if not (UPLOAD_DIR / name).exists()]
+        if missing:
+            errors.append(f"{prefix}输入图片不存在: {', '.join(missing)}（请先通过 /upload_image 上传）")
+            continue
+        key = json.dumps(request.dict(exclude=VALIDATION_FREE_TEXT_FIELDS), sort_keys=True)
+        if key not in checked:
+            try:
+                await backend_pool.validate_workflow(create_workflow(request))
+                checked[key] = []
+            except WorkflowValidationError as e:
+                checked[key] = e.errors
+            except (KeyError, ValueError) as e:
+                checked[key] = [str(e)]
+        errors.extend(f"{prefix}{error}" for error in checked[key])
+    if errors:
+        raise HTTPException(status_code=422, detail={"message": "工作流校验失败", "errors": errors[:50]})
 
 @app.post("/generate")
-async def generate_single(request: GenerationRequest, background_tasks: BackgroundTasks):
+async def generate_single(request: GenerationRequest):
     """单个图像生成"""
+    await validate_generation_requests([request])
     task_id = task_manager.create_task(request.dict(), request.batch_name)
     
-    # 后台处理任务
-    background_tasks.add_task(process_single_task, task_id, request, task_manager)
+    # 加入调度队列
+    scheduler.submit(task_id, request)
     
     return {"task_id": task_id, "message": "任务已提交"}
 
 @app.post("/batch")
-async def generate_batch(batch_request: BatchRequest, background_tasks: BackgroundTasks):
+async def generate_batch(batch_request: BatchRequest):
     """批量图像生成"""
-    task_ids = []
     batch_name = batch_request.batch_name or f"batch_{int(time.time())}"
+    await validate_generation_requests(batch_request.requests)
     
     for request in batch_request.requests:
         request.batch_name = batch_name
-        task_id = task_manager.create_task(request.dict(), batch_name)
-        task_ids.append(task_id)
-        
-        # 后台处理任务
-        background_tasks.add_task(process_single_task, task_id, request, task_manager)
-        
-        # 添加小延迟避免服务器压力过大
-        await asyncio.sleep(0.1)
+    
+    # 一个事务批量插入所有任务
+    task_ids = await task_manager.create_tasks(
+        [(request.dict(), batch_name) for request in batch_request.requests],
+        batch_request.priority
+    )
+    
+    # 按批次优先级加入调度队列，由worker池按并发上限执行
+    for task_id, request in zip(task_ids, batch_request.requests):
+        scheduler.submit(task_id, request, batch_request.priority)
+    
+    return {
+        "batch_name": batch_name,
+        "task_ids": task_ids,
+        "message": f"已提交 {len(task_ids)} 个任务"
+    }
+
+@app.post("/workflow")
+async def submit_workflow(workflow_request: WorkflowBatchRequest):
+    """提交任意工作流（API格式工作流或已注册模板 + 参数覆盖），variants中每个变体生成一个任务"""
+    batch_name = workflow_request.batch_name or f"workflow_{int(time.time())}"
+    variants = workflow_request.variants or [WorkflowVariant()]
+    
+    requests = []
+    errors = []
+    for index, variant in enumerate(variants):
+        prefix = f"variants[{index}]: " if workflow_request.variants else ""
+        try:
+            request = merge_workflow_variant(workflow_request, variant)
+            request.batch_name = batch_name
+            template = get_workflow_request_template(request)
+            # 模板的随机种子在提交时固定，重启恢复后重新生成结果一致
+            if "seed" in template.bindings and request.params.get("seed") is None:
+                request.params["seed"] = random.randint(0, 2**32 - 1)
+            workflow, _ = create_custom_workflow(request)
+        except (KeyError, ValueError) as e:
+            errors.append(f"{prefix}{e.args[0] if e.args else e}")
+            continue
+        missing = [name for name in request.images.values() if not (UPLOAD_DIR / name).exists()]
+        if missing:
+            errors.append(f"{prefix}输入图片不存在: {', '.join(missing)}（请先通过 /upload_image 上传）")
+            continue
+        try:
+            await backend_pool.validate_workflow(workflow)
+        except WorkflowValidationError as e:
+            errors.extend(f"{prefix}{error}" for error in e.errors)
+            continue
+        requests.append(request)
+    if errors:
+        raise HTTPException(status_code=422, detail={"message": "工作流校验失败", "errors": errors[:50]})
+    
+    task_ids = await task_manager.create_tasks(
+        [({"kind": "workflow", **request.dict()}, batch_name) for request in requests],
+        workflow_request.priority
+    )
+    for task_id, request in zip(task_ids, requests):
+        scheduler.submit(task_id, request, workflow_request.priority)
+    
+    return {
+        "batch_name": batch_name,
+        "task_ids": task_ids,
+        "message": f"已提交 {len(task_ids)} 个任务"
+    }
+
+@app.post("/pipeline")
+async def submit_pipeline(pipeline_request: PipelineBatchRequest):
+    """提交多阶段流水线（如 文生图 → 角色抠图），各阶段在同一ComfyUI节点上衔接，variants中每个变体一个任务"""
+    if not pipeline_request.stages:
+        raise HTTPException(status_code=422, detail={"message": "流水线校验失败", "errors": ["stages 不能为空"]})
+    batch_name = pipeline_request.batch_name or f"pipeline_{int(time.time())}"
+    variants = pipeline_request.variants or [WorkflowVariant()]
+    
+    requests = []
+    errors = []
+    for variant_index, variant in enumerate(variants):
+        variant_prefix = f"variants[{variant_index}]." if pipeline_request.variants else ""
+        images = {**pipeline_request.images, **variant.images}
+        missing = [name for name in images.values() if not (UPLOAD_DIR / name).exists()]
+        if missing:
+            errors.append(f"{variant_prefix}输入图片不存在: {', '.join(missing)}（请先通过 /upload_image 上传）")
+            continue
+        stages = []
+        for index, stage in enumerate(pipeline_request.stages):
+            prefix = f"{variant_prefix}stages[{index}]: "
+            stage = stage.copy(deep=True)
+            try:
+                if index == 0:
+                    # 变体只覆盖第一阶段的参数
+                    stage.params = {**stage.params, **variant.params}
+                    stage.overrides = {f"{node_id}.{input_name}": value for (node_id, input_name), value
+                                       in parse_overrides(stage.overrides) + parse_overrides(variant.overrides)}
+                template = get_workflow_request_template(stage_workflow_request(stage))
+                # 模板的随机种子在提交时固定，重启恢复后重新生成结果一致
+                if "seed" in template.bindings and stage.params.get("seed") is None:
+                    stage.params = {**stage.params, "seed": random.randint(0, 2**32 - 1)}
+                # 后续阶段的输入图片在运行时才产生，这里用占位文件名校验工作流结构
+                stage_images = images if index == 0 else {get_stage_input(stage): "pipeline_input.png [output]"}
+                workflow, _ = create_custom_workflow(stage_workflow_request(stage, stage_images))
+                await backend_pool.validate_workflow(workflow)
+            except WorkflowValidationError as e:
+                errors.extend(f"{prefix}{error}" for error in e.errors)
+                continue
+            except (KeyError, ValueError) as e:
+                errors.append(f"{prefix}{e.args[0] if e.args else e}")
+                continue
+            stages.append(stage)
+        requests.append(PipelineRequest(stages=stages, images=images, batch_name=batch_name))
+    if errors:
+        raise HTTPException(status_code=422, detail={"message": "流水线校验失败", "errors": errors[:50]})
+    
+    task_ids = await task_manager.create_tasks(
+        [({"kind": "pipeline", **request.dict()}, batch_name) for request in requests],
+        pipeline_request.priority
+    )
+    for task_id, request in zip(task_ids, requests):
+        scheduler.submit(task_id, request, pipeline_request.priority)
     
     return {
         "batch_name": batch_name,
@@ -1058,50 +3802,195 @@ async def generate_batch(batch_request: BatchRequest, background_tasks: Backgrou
 @app.get("/status/{task_id}")
 async def get_task_status(task_id: str):
     """获取任务状态"""
-    task = task_manager.get_task(task_id)
+    task = await task_manager.get_task(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="任务未找到")
     
     return task
 
+def encode_tasks_cursor(key: Tuple[str, str]) -> str:
+    """把 (created_at, task_id) 编码为不透明游标"""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_tasks_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, task_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return str(created_at), str(task_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的cursor")
+
+def normalize_time_filter(value: Optional[str], name: str) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} 必须是ISO格式时间")
+
 @app.get("/tasks")
-async def get_all_tasks():
-    """获取所有任务"""
-    return {"tasks": task_manager.get_all_tasks()}
+async def get_all_tasks(
+    status: Optional[str] = Query(None, description="按状态过滤，多个用逗号分隔，如 pending,running"),
+    batch_name: Optional[str] = Query(None, description="按批次名称过滤"),
+    created_after: Optional[str] = Query(None, description="创建时间下限（含），ISO格式"),
+    created_before: Optional[str] = Query(None, description="创建时间上限（不含），ISO格式"),
+    limit: int = Query(TASKS_PAGE_DEFAULT, ge=1, le=TASKS_PAGE_MAX, description="每页条数"),
+    cursor: Optional[str] = Query(None, description="上一页返回的next_cursor"),
+    fields: Optional[str] = Query(None, description="只返回指定字段，逗号分隔，如 task_id,status,progress")
+):
+    """分页获取任务列表（按创建时间倒序）"""
+    statuses = [s.strip() for s in status.split(",") if s.strip()] if status else None
+    field_list = None
+    if fields:
+        field_list = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in field_list if f not in TaskManager.QUERY_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"未知字段: {', '.join(unknown)}")
+    
+    tasks, next_key = await task_manager.query_tasks(
+        statuses=statuses,
+        batch_name=batch_name,
+        created_after=normalize_time_filter(created_after, "created_after"),
+        created_before=normalize_time_filter(created_before, "created_before"),
+        limit=limit,
+        after=decode_tasks_cursor(cursor) if cursor else None,
+        fields=field_list
+    )
+    return {
+        "tasks": tasks,
+        "count": len(tasks),
+        "next_cursor": encode_tasks_cursor(next_key) if next_key else None
+    }
+
+async def handle_ws_message(client: WebSocketClient, text: str):
+    """处理客户端的订阅消息
+
+    {"action": "subscribe", "task_ids": [...], "batch_names": [...], "all": true}
+    {"action": "unsubscribe", "task_ids": [...], "batch_names": [...], "all": true}
+    """
+    try:
+        message = json.loads(text)
+        action = message.get("action")
+        task_ids = [str(t) for t in message.get("task_ids") or []]
+        batch_names = [str(b) for b in message.get("batch_names") or []]
+        subscribe_all = bool(message.get("all"))
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        client.enqueue(json.dumps({"type": "error", "data": {"message": "无效的消息格式"}}))
+        return
+    
+    if action == "subscribe":
+        task_manager.subscriptions.subscribe(client, task_ids, batch_names, all=subscribe_all)
+    elif action == "unsubscribe":
+        task_manager.subscriptions.unsubscribe(client, task_ids, batch_names, all=subscribe_all)
+    else:
+        client.enqueue(json.dumps({"type": "error", "data": {"message": f"未知操作: {action}"}}))
+        return
+    
+    client.enqueue(json.dumps({
+        "type": "subscriptions",
+        "data": task_manager.subscriptions.describe(client)
+    }))
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket实时更新"""
+async def websocket_endpoint(websocket: WebSocket, subscribe: str = "all", since: Optional[int] = None):
+    """WebSocket实时更新
+
+    默认订阅全部任务（兼容旧客户端）；连接时带 ?subscribe=none 则只接收之后显式订阅的任务/批次。
+    断线重连时带上 ?since=<最后收到的seq>，服务器会补发期间错过的事件。
+    """
     await websocket.accept()
-    task_manager.websocket_connections.append(websocket)
+    subscriptions = task_manager.subscriptions
+    client = WebSocketClient(websocket, subscriptions.send_stats, on_evict=subscriptions.remove_connection)
+    task_manager.attach_client(client, subscribe_all=(subscribe != "none"), since=since)
+    client.start()
     
     try:
         while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        task_manager.websocket_connections.remove(websocket)
+            text = await websocket.receive_text()
+            await handle_ws_message(client, text)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        subscriptions.remove_connection(client)
+        await client.close()
+
+@app.get("/events")
+async def event_stream(
+    task_ids: Optional[str] = Query(None, description="只接收这些任务的事件，逗号分隔"),
+    batch_names: Optional[str] = Query(None, description="只接收这些批次的事件，逗号分隔"),
+    since: Optional[int] = Query(None, description="从该seq之后开始补发"),
+    last_event_id: Optional[str] = Header(None)
+):
+    """任务事件流（Server-Sent Events），消息格式与 /ws 相同
+
+    不指定任务/批次时接收全部任务；浏览器 EventSource 断线重连会自动带上 Last-Event-ID 补发事件。
+    """
+    if since is None and last_event_id:
+        try:
+            since = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的Last-Event-ID")
+    
+    task_id_list = [t.strip() for t in task_ids.split(",") if t.strip()] if task_ids else []
+    batch_name_list = [b.strip() for b in batch_names.split(",") if b.strip()] if batch_names else []
+    
+    subscriptions = task_manager.subscriptions
+    client = EventStreamClient(subscriptions.send_stats, on_evict=subscriptions.remove_connection)
+    task_manager.attach_client(client, subscribe_all=not (task_id_list or batch_name_list),
+                               task_ids=task_id_list, batch_names=batch_name_list, since=since)
+    client.start()
+    
+    async def stream():
+        try:
+            async for frame in client.frames():
+                yield frame
+        finally:
+            subscriptions.remove_connection(client)
+            await client.close()
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/workflow_templates")
+async def list_workflow_templates():
+    """列出已加载的工作流模板"""
+    return {"templates": workflow_templates.list()}
 
 @app.get("/health")
 async def health_check():
     """健康检查"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{COMFYUI_SERVER}/system_stats", timeout=5) as response:
-                comfyui_status = "online" if response.status == 200 else "offline"
-    except:
-        comfyui_status = "offline"
+    await backend_pool.refresh_all()
+    comfyui_status = "online" if any(b.healthy for b in backend_pool.backends) else "offline"
     
     return {
         "api_server": "online",
         "comfyui_server": comfyui_status,
-        "active_tasks": len(task_manager.active_tasks)
+        "comfyui_backends": [b.to_dict() for b in backend_pool.backends],
+        "active_tasks": task_manager.active_tasks.active_count()
+    }
+
+@app.get("/stats")
+async def get_stats():
+    """运行时统计信息"""
+    return {
+        "comfyui_http": comfy_pool.get_stats(),
+        "image_downloads": comfy_pool.get_download_stats(),
+        "comfyui_backends": backend_pool.get_stats(),
+        "image_uploads": backend_pool.get_upload_stats(),
+        "result_delivery": backend_pool.get_delivery_stats(),
+        "scheduler": scheduler.get_stats(),
+        "database": task_manager.db.get_stats(),
+        "task_writes": task_manager.get_write_stats(),
+        "task_cache": task_manager.active_tasks.get_stats(),
+        "websocket": task_manager.subscriptions.get_stats(),
+        "task_events": {**task_manager.event_stats, **task_manager.events.get_stats()}
     }
 
 if __name__ == "__main__":
     import uvicorn
     
     print("🚀 启动ComfyUI批量生图API服务器")
-    print(f"📡 ComfyUI服务器: {COMFYUI_SERVER}")
+    print(f"📡 ComfyUI服务器: {', '.join(COMFYUI_SERVERS)}")
     print(f"📁 图像输出目录: {OUTPUT_DIR}")
     print("🌐 API文档: http://localhost:8001/docs")
     